@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import pathlib
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Benchmarks of the round pipeline. Results are written as JSON, so runs of different commits can be compared:
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+# Everything runs in a temporary folder, the results folder of the project is not touched.
+
+REPO = pathlib.Path(__file__).resolve().parent
+SIZES = [5, 10, 15, 20]
+TRAPS = [0.0, 0.1, 0.3]
+REPEATS = 20 # Repetitions of the short benchmarks, the median is reported
+TRAIN_BUDGET = 2000 # Small fixed budget, so train() finishes in reasonable time
+TIMELINE_ROUNDS = 10
+IMAGE_SIZE = 800 # Size of the fake result images used for compositing
+ROUND_PORT = 10122 # Ports of the socket2 instance started for the round benchmark
+ROUND_NOTIFY_PORT = 10123
+
+def maze_settings(seed, size, traps, start="SOUTH_WEST"):
+    # Same shape as the settings MainWindow.save_settings sends
+    return {"Seed": seed, "Size": size, "Traps": traps, "Without intersections": True, "Start": start}
+
+def timed(function, repeats=REPEATS):
+    # Median and minimum of the wall time of function() in seconds
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "min": min(times), "repeats": repeats}
+
+def bench_make_string():
+    from training import make_string
+    results = {}
+    for size in SIZES:
+        for traps in TRAPS:
+            settings = [maze_settings(seed, size, traps) for seed in range(4)]
+            results[f"size={size},traps={traps}"] = timed(lambda: make_string(settings))
+    return results
+
+def bench_train(budget=TRAIN_BUDGET):
+    import training
+    training.BUDGET = budget
+    # Every size trains the same fixed number of timesteps, so timesteps per second can be compared
+    training.ADAPTIVE_BUDGET = False
+    training.PLATEAU_EVALS = None
+    results = {}
+    for size in SIZES:
+        simple_str = training.make_string([maze_settings(0, size, 0.0)])[0]
+        start = time.perf_counter()
+        _, stats = training.train(simple_str, f"bench_train/{size}")
+        seconds = time.perf_counter() - start
+        training_seconds = stats["learn"] + sum(stats["evals"])
+        results[f"size={size}"] = {
+            "seconds": seconds,
+            "solved": stats["solved"], # Reached the optimal reward, seconds is then the time to the threshold
+            "timesteps": stats["timesteps"],
+            "timesteps_per_second": stats["timesteps"] / training_seconds if training_seconds else None,
+            "env": stats["env"], "learn": stats["learn"], "evals": sum(stats["evals"]),
+        }
+    return results
+
+def fake_image(seed):
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.new("RGB", (IMAGE_SIZE, IMAGE_SIZE), (255, 255, 255))
+    for _ in range(200):
+        x, y = rng.randrange(IMAGE_SIZE - 20), rng.randrange(IMAGE_SIZE - 20)
+        image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + 20, y + 20))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def bench_timeline(rounds=TIMELINE_ROUNDS):
+    from timeline import persist_round, build_timeline
+    images = [fake_image(i) for i in range(4)]
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        persist_round("bench", images)
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    build_timeline("bench")
+    return {"round_median": statistics.median(times), "round_max": max(times), "rounds": rounds,
+            "build_timeline": time.perf_counter() - start}
+
+def bench_round(rounds=1):
+    # Full rounds through socket2.handle_client_connection, with local_sbatch.py standing in for SLURM
+    import socket2
+    from protocol import request_round
+
+    script = pathlib.Path("bench_job.sh")
+    script.write_text(f'exec "{sys.executable}" "{REPO / "worker2.py"}" "$@"\n')
+    local_sbatch = [sys.executable, str(REPO / "local_sbatch.py")]
+    socket2.SBATCH = local_sbatch + ["sbatch"]
+    socket2.SACCT = socket2.SQUEUE = local_sbatch + ["sacct"]
+    socket2.SCANCEL = local_sbatch + ["scancel"]
+    socket2.SLURM_SCRIPT = str(script)
+    socket2.HOST, socket2.PORT = "127.0.0.1", ROUND_PORT
+    socket2.NOTIFY_HOST, socket2.NOTIFY_PORT = "127.0.0.1", ROUND_NOTIFY_PORT
+    socket2.METRICS_PORT = None
+    threading.Thread(target=lambda: asyncio.run(socket2.serve()), daemon=True).start()
+    time.sleep(1)
+
+    times = []
+    for i in range(rounds):
+        data = {"participant_id": f"bench{i}", "maze_data": [maze_settings(seed, 5, 0.0) for seed in range(4)],
+                "selected": None, "final": False, "round": 1}
+        start = time.perf_counter()
+        response = request_round(socket2.HOST, socket2.PORT, data)
+        if response.get("status") != "ok":
+            raise RuntimeError(f"Round failed: {response}")
+        times.append(time.perf_counter() - start)
+    return {"median": statistics.median(times), "max": max(times), "rounds": rounds}
+
+BENCHMARKS = {"make_string": bench_make_string, "train": bench_train, "timeline": bench_timeline, "round": bench_round}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def flatten(results, prefix=""):
+    # {"a": {"b": 1}} -> {"a.b": 1}, only numbers are kept
+    values = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{name}"] = value
+    return values
+
+def compare(old, new):
+    old_values, new_values = flatten(old["results"]), flatten(new["results"])
+    print(f"Compared to {old.get('commit')}:")
+    for name, value in new_values.items():
+        if name in old_values and old_values[name]:
+            print(f"  {name}: {old_values[name]:.4g} -> {value:.4g} ({value / old_values[name]:.2f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the round pipeline")
+    parser.add_argument('--output', type=str, default=None, help='JSON file the results are written to')
+    parser.add_argument('--only', type=str, nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('--budget', type=int, default=TRAIN_BUDGET, help='Timesteps of the train benchmark')
+    parser.add_argument('--rounds', type=int, default=1, help='Rounds of the round benchmark')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier results to compare with')
+    args = parser.parse_args()
+    output = pathlib.Path(args.output or f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json").resolve()
+    earlier = pathlib.Path(args.compare).resolve() if args.compare else None
+
+    report = {"commit": git_commit(), "time": time.time(), "python": platform.python_version(),
+              "machine": platform.machine(), "cpus": os.cpu_count(), "results": {}}
+    options = {"train": {"budget": args.budget}, "round": {"rounds": args.rounds}}
+    sys.path.insert(0, str(REPO))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            for name in args.only:
+                print(f"Running {name}...")
+                report["results"][name] = BENCHMARKS[name](**options.get(name, {}))
+        finally:
+            os.chdir(cwd)
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if earlier is not None:
+        with open(earlier, "r") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import io
+import json
+import os
+import pathlib
+import threading
+import time
+
+import numpy as np
+import PIL.Image
+from stable_baselines3.common.callbacks import EvalCallback
+from stable_baselines3.common.evaluation import evaluate_policy
+from stable_baselines3.common.logger import KVWriter
+from stable_baselines3.common.vec_env.base_vec_env import tile_images
+
+from amaze.extensions.sb3 import env_method
+
+class ReportingEvalCallback(EvalCallback):
+    # EvalCallback that also reports every evaluation, so the participant can follow the training.
+    # The time every evaluation took is kept in eval_seconds.
+    def __init__(self, *args, progress=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.progress = progress
+        self.eval_seconds = []
+
+    def _on_step(self):
+        evaluating = self.eval_freq > 0 and self.n_calls % self.eval_freq == 0
+        start = time.perf_counter()
+        continue_training = super()._on_step()
+        if evaluating:
+            self.eval_seconds.append(time.perf_counter() - start)
+        if self.progress is not None and evaluating:
+            self.progress({"event": "eval", "timestep": int(self.num_timesteps),
+                           "reward": float(self.last_mean_reward)})
+        return continue_training
+
+class MemoryOutputFormat(KVWriter):
+    # Output of the SB3 logger that keeps the logged values in memory, instead of writing files while training.
+    # Values only meant for tensorboard, such as images and hyperparameters, are left out.
+    def __init__(self):
+        self.steps = []
+        self.columns = {} # Key -> values, None for the dumps the key was not logged in
+
+    def write(self, key_values, key_excluded, step=0):
+        row = len(self.steps)
+        self.steps.append(step)
+        for key, value in key_values.items():
+            if "json" in (key_excluded.get(key) or ()):
+                continue
+            if isinstance(value, np.generic):
+                value = value.item()
+            if not isinstance(value, (int, float, str)):
+                continue
+            column = self.columns.setdefault(key, [])
+            column.extend([None] * (row - len(column)))
+            column.append(value)
+
+    def table(self):
+        # Columns of equal length, with the timestep of every dump in "step"
+        rows = len(self.steps)
+        return dict(step=self.steps, **{key: column + [None] * (rows - len(column))
+                                        for key, column in self.columns.items()})
+
+    def close(self):
+        pass
+
+_log_lock = threading.Lock()
+
+def append_learning_log(path, stats, **tags):
+    # Appends a training to a learning log, one JSON line with its table and stop reason, written in one go
+    line = json.dumps(dict(time=time.time(), stop=stats.get("stop"), timesteps=stats.get("timesteps"),
+                           log=stats.get("log"), **tags), default=str)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _log_lock, open(path, "a") as f:
+        f.write(line + "\n")
+
+class ProgressReporter:
+    # Puts the events of one training on a queue together with the key of the training.
+    # Works from the training processes too, if the queue comes from a multiprocessing manager.
+    def __init__(self, events, key):
+        self.events = events
+        self.key = key
+
+    def __call__(self, event):
+        self.events.put((self.key, event))
+
+def save_trajectories(model, env, folder, name="final"):
+    # Runs one episode of model in every environment of env and saves the trajectories as one image, at the
+    # place TensorboardCallback puts them (trajectories/eval_{name}.png). env has to log trajectories.
+    # Returns the PNG bytes, so the image does not have to be read back from the file.
+    evaluate_policy(model, env, n_eval_episodes=env.num_envs)
+    images = env_method(env, "plot_trajectory", verbose=True, cb_side=0, square=True)
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(tile_images(images)).save(buffer, format="PNG")
+    image = buffer.getvalue()
+    path = pathlib.Path(folder) / "trajectories" / f"eval_{name}.png"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(image) # Kept for the cache and the results store
+    return image
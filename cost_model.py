@@ -0,0 +1,100 @@
+import json
+import math
+import os
+import threading
+import time
+
+# Predicts how long a training takes from the maze settings. Every training is appended to TRAINING_LOG,
+# the model is a small least squares fit of the log of the wall time on the settings, refit when the log changes.
+# Until there are MIN_RECORDS trainings the mean of the log, or PRIOR_SECONDS, is used instead.
+TRAINING_LOG = os.environ.get("TRAINING_LOG", "results/training_log.jsonl")
+PRIOR_SECONDS = 300 # Guess for a training while nothing was recorded yet
+MIN_RECORDS = 10
+RIDGE = 0.01 # Keeps the fit stable while few settings were seen
+
+def features(size, traps, unicursive, warm_start):
+    return [1.0, size, size * size, traps, float(bool(unicursive)), float(bool(warm_start))]
+
+def settings_features(settings, warm_start=False):
+    # settings as the interface sends them for one maze, Traps is a percentage and recorded as a probability
+    return features(settings["Size"], settings["Traps"] / 100, settings["Without intersections"], warm_start)
+
+def _solve(a, b):
+    # Gaussian elimination with partial pivoting, a is square
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            return None
+        for r in range(n):
+            if r != col:
+                factor = m[r][col] / m[col][col]
+                m[r] = [x - factor * y for x, y in zip(m[r], m[col])]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+def fit(records):
+    # Ridge regression of log(seconds) on the features, returns the weights or None
+    rows = [(features(record["size"], record["traps"], record["unicursive"], record["warm_start"]),
+             math.log(max(record["seconds"], 1e-3))) for record in records]
+    n = len(rows[0][0])
+    a = [[sum(x[i] * x[j] for x, _ in rows) + (RIDGE if i == j and i > 0 else 0) for j in range(n)]
+         for i in range(n)]
+    b = [sum(x[i] * y for x, y in rows) for i in range(n)]
+    return _solve(a, b)
+
+class CostModel:
+    def __init__(self, log_path=TRAINING_LOG):
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.weights = None
+        self.mean = None # Mean wall time, used while there are too few records to fit
+        self.longest = None # Predictions are capped at twice the longest training seen, the fit extrapolates badly
+
+    def record_training(self, maze_data, warm_start, stats, p_trap=0.0, **tags):
+        # maze_data is the Maze.BuildData of the training, stats what train() returned. p_trap is the trap probability
+        # the participant asked for, Traps / 100, maze_data has none since the servers add no trap signs.
+        seconds = stats["env"] + stats["learn"] + sum(stats["evals"])
+        record = dict(time=time.time(), size=maze_data.width, traps=p_trap, unicursive=maze_data.unicursive,
+                      warm_start=bool(warm_start), seconds=seconds, timesteps=stats.get("timesteps"),
+                      solved=stats.get("solved"), stop=stats.get("stop"), budget=stats.get("budget"), **tags)
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with self.lock, open(self.log_path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+    def refresh(self):
+        # Refits when other processes (training jobs, pretrain.py) added trainings to the log
+        try:
+            mtime = os.path.getmtime(self.log_path)
+        except OSError:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            records = []
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError: # Line still being written
+                        continue
+            self.mtime = mtime
+            self.mean = sum(record["seconds"] for record in records) / len(records) if records else None
+            self.longest = max((record["seconds"] for record in records), default=None)
+            self.weights = fit(records) if len(records) >= MIN_RECORDS else None
+
+    def predict(self, x):
+        # Seconds a training with the features x is expected to take
+        self.refresh()
+        if self.weights is not None:
+            return min(math.exp(sum(w * v for w, v in zip(self.weights, x))), 2 * self.longest)
+        return self.mean if self.mean is not None else PRIOR_SECONDS
+
+    def round_seconds(self, mazes, warm_start=False, workers=1):
+        # Expected time of a round: its mazes train on up to workers processes at once
+        costs = [self.predict(settings_features(settings, warm_start)) for settings in mazes]
+        if not costs:
+            return 0
+        return max(max(costs), sum(costs) / workers)
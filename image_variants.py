@@ -0,0 +1,46 @@
+import collections
+import hashlib
+import io
+import threading
+
+from PIL import Image
+
+# Clients that ask for it get small display-sized copies of the result images.
+# The full resolution images stay on the server and are sent when a client asks for one by id.
+THUMBNAIL_FORMAT = "JPEG" # WEBP is smaller, but the client then needs the Qt image format plugins
+THUMBNAIL_QUALITY = 85
+MAX_THUMBNAIL_SIZE = 1024 # Larger requests are capped, so a client cannot ask for more than the original
+STORED_IMAGES = 256 # Full resolution images kept for zooming, the oldest are dropped first
+
+def image_id(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()[:32]
+
+def make_thumbnail(image_bytes, size):
+    # Scales the image down to fit in size x size, smaller images only change format
+    size = max(1, min(int(size), MAX_THUMBNAIL_SIZE))
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = image.convert("RGB") # JPEG has no alpha channel
+        image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+class ImageStore:
+    # Full resolution images by id, bounded and shared between the connections of a server
+    def __init__(self, max_images=STORED_IMAGES):
+        self.max_images = max_images
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, image_bytes):
+        key = image_id(image_bytes)
+        with self.lock:
+            self.images[key] = image_bytes
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return key
+
+    def get(self, key):
+        with self.lock:
+            return self.images.get(key)
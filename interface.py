@@ -1,51 +1,177 @@
-import json
+import collections
+import concurrent.futures
 import socket
+import threading
 import amaze
-import base64
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QObject, QThread, pyqtSignal
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QSpinBox, QDoubleSpinBox,
+from PyQt5.QtWidgets import (QApplication, QWidget, QHBoxLayout, QVBoxLayout, QFormLayout, QSpinBox, QDoubleSpinBox,
                              QPushButton, QCheckBox, QComboBox,
                              QMessageBox, QDialog, QLabel, QGridLayout, QScrollArea, QLineEdit)
 
-BUFFER_SIZE = 4096
+from protocol import request_round, fetch_image, make_request
+
 HOST = 'localhost'# Change to ip of where server is located
 PORT = 50000
-
-def send_to_server(participant_id=None, maze_strings=None):
+TIMEOUT = 900 # Seconds without any message from the server before giving up on a round, servers send one every HEARTBEAT
+FETCH_TIMEOUT = 15 # Seconds to wait for a full resolution image
+PREVIEW_DELAY = 150 # Milliseconds without changes before a maze preview is generated
+PREVIEW_CACHE_SIZE = 64 # Generated mazes kept, so going back to earlier settings is instant
+THUMBNAIL_SIZE = 320 # The server sends the results at this size, the full image is fetched when clicking on one
+
+def send_to_server(participant_id=None, maze_strings=None, selected=None, on_event=None):
+    # Returns the answer of the server, with the result images as PNG bytes under "images".
+    # on_event(event, image=None) receives the progress of the training while waiting.
+    # Blocks until the round is done, the interface itself uses ServerWorker instead.
     try:
-        server_address = (HOST, PORT)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-            client_socket.connect(server_address)
-
-            # Combine participant ID and maze_strings into one JSON object
-            data = {
-                "participant_id": participant_id,
-                "maze_data": maze_strings
-            }
-            data_json = json.dumps(data)
-            client_socket.sendall(data_json.encode())
-
-        # Receive response from the server in chunks
-            response = b""
-            while True:
-                chunk = client_socket.recv(BUFFER_SIZE)
-                if not chunk:
-                    break
-                response += chunk
-            response = response.decode()
-            return response
+        return request_round(HOST, PORT, make_request(participant_id, maze_strings, selected,
+                                                          thumbnail_size=THUMBNAIL_SIZE), on_event=on_event)
 
     except Exception as e:
         print(f"Error: {e}")
         return None
 
-    finally:
-        client_socket.close()
+class ServerWorker(QObject): # Talks to the server in its own thread, so the interface keeps repainting
+    progress = pyqtSignal(dict, object)  # Event, image bytes or None
+    finished = pyqtSignal(dict)  # Complete answer of the server
+    error = pyqtSignal(str)
+    timeout = pyqtSignal()
+
+    def __init__(self, participant_id, maze_strings, selected, final=False, round_number=None):
+        super().__init__()
+        self.data = make_request(participant_id, maze_strings, selected, final, round_number, THUMBNAIL_SIZE)
+
+    def run(self):
+        try:
+            response = request_round(HOST, PORT, self.data, timeout=TIMEOUT, on_event=self._on_event)
+        except socket.timeout:
+            self.timeout.emit()
+        except Exception as e:
+            print(f"Error: {e}")
+            self.error.emit(str(e))
+        else:
+            self.finished.emit(response)
+
+    def _on_event(self, event, image=None):
+        self.progress.emit(event, image)
+
+
+class MazePreviewer(QObject): # Generates the mazes of the previews off the GUI thread and keeps the recent ones
+    ready = pyqtSignal(object, str, object)  # Maze widget, key, maze
+
+    def __init__(self):
+        super().__init__()
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.latest = {}  # Maze widget -> key of the maze it should show, results of older requests are dropped
+        self.ready.connect(self._show)
+
+    def request(self, maze_widget, build_data):
+        key = build_data.to_string()
+        self.latest[maze_widget] = key
+        with self.lock:
+            maze = self.cache.get(key)
+            if maze is not None:
+                self.cache.move_to_end(key)
+        if maze is not None:
+            maze_widget.set_maze(maze)
+        else:
+            self.executor.submit(self._generate, maze_widget, key, build_data)
+
+    def _generate(self, maze_widget, key, build_data): # Runs in the executor thread
+        if self.latest.get(maze_widget) != key: # Settings changed again while waiting
+            return
+        with self.lock:
+            maze = self.cache.get(key) # Generated by an earlier request for the same settings
+        try:
+            if maze is None:
+                maze = amaze.Maze.generate(build_data)
+        except Exception as e:
+            print(f"Error: {e}")
+            return
+        with self.lock:
+            self.cache[key] = maze
+            while len(self.cache) > PREVIEW_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.ready.emit(maze_widget, key, maze)
+
+    def _show(self, maze_widget, key, maze): # Back in the GUI thread
+        if self.latest.get(maze_widget) == key:
+            maze_widget.set_maze(maze)
+
+
+class ImageFetcher(QThread): # Gets a full resolution image from the server
+    # Belongs to the application rather than to the window that asked for the image, the window may be closed
+    # while the fetch still runs. A fetch cannot be interrupted, it ends within FETCH_TIMEOUT and deletes itself.
+    loaded = pyqtSignal(object)  # Image bytes, or None if the server no longer has the image
+    error = pyqtSignal(str)
+
+    def __init__(self, image_id):
+        super().__init__(QApplication.instance())
+        self.image_id = image_id
+        self.finished.connect(self.deleteLater)
+
+    def run(self):
+        try:
+            image = fetch_image(HOST, PORT, self.image_id, timeout=FETCH_TIMEOUT)
+        except Exception as e:
+            print(f"Error: {e}")
+            self.error.emit(str(e))
+        else:
+            self.loaded.emit(image)
+
+
+class ZoomWindow(QDialog): # Full resolution version of a result
+    def __init__(self, image_id, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_DeleteOnClose) # Also when closed with Esc
+        self.setWindowTitle("Result trajectory")
+        self.resize(1000, 800)
+        scroll_area = QScrollArea()
+        scroll_area.setWidgetResizable(True)
+        self.label = QLabel("Loading the full image...")
+        self.label.setAlignment(Qt.AlignCenter)
+        scroll_area.setWidget(self.label)
+        main_layout = QVBoxLayout()
+        main_layout.addWidget(scroll_area)
+        self.setLayout(main_layout)
+
+        # Connected to methods of the window, so the connections are dropped when the window is deleted first
+        fetcher = ImageFetcher(image_id)
+        fetcher.loaded.connect(self.show_image)
+        fetcher.error.connect(self.show_error)
+        fetcher.start()
+
+    def show_image(self, image):
+        if image is None:
+            self.label.setText("The server no longer has the full image.")
+            return
+        pixmap = QPixmap()
+        pixmap.loadFromData(image)
+        self.label.setPixmap(pixmap)
+
+    def show_error(self, message):
+        self.label.setText("Could not load the full image.")
+
+
+class ResultLabel(QLabel): # Opens the full image when clicked, if the server sent an id for it
+    def __init__(self, image_id=None):
+        super().__init__()
+        self.image_id = image_id
+        self.zoom_window = None
+        if image_id is not None:
+            self.setToolTip("Click to enlarge")
+            self.setCursor(Qt.PointingHandCursor)
+
+    def mousePressEvent(self, event):
+        if self.image_id is not None:
+            self.zoom_window = ZoomWindow(self.image_id, self)
+            self.zoom_window.exec_()
 
 
 class ImageWindow(QDialog):
-    def __init__(self, images, maze_strings, update_callback):
+    def __init__(self, images, maze_strings, update_callback, image_ids=None):
         super().__init__()
         self.setWindowTitle("Result trajectories")
         self.resize(1000, 800)
@@ -59,15 +185,15 @@ class ImageWindow(QDialog):
         content_widget = QWidget()
         scroll_area.setWidget(content_widget)
         layout = QGridLayout(content_widget)
-        max_image_size = 320  # Adjust this value if need be
+        max_image_size = THUMBNAIL_SIZE  # Adjust this value if need be
 
         # Use the images in the layout
         for index, image_data in enumerate(images):
             pixmap = QPixmap()
-            pixmap.loadFromData(base64.b64decode(image_data))
+            pixmap.loadFromData(image_data)
             scaled_pixmap = pixmap.scaled(max_image_size, max_image_size, Qt.KeepAspectRatio)
 
-            label = QLabel()
+            label = ResultLabel(image_ids[index] if image_ids else None)
             label.setPixmap(scaled_pixmap)
             layout.addWidget(label, index // 2, index % 2)  # Arrange images in a grid
 
@@ -96,7 +222,7 @@ class ImageWindow(QDialog):
             if 0 <= selected_index < len(self.images):
                 new_maze_string = self.maze_strings[selected_index]
                 #print("Selected Maze String:", new_maze_string)
-                self.update_callback(new_maze_string)
+                self.update_callback(new_maze_string, selected_index)
                 self.accept()
             else:
                 print("Invalid index")
@@ -112,7 +238,7 @@ class ImageWindow(QDialog):
             event.accept()  # Closing the window with an id in the input box is also not possible
 
 class ImageWindowRounds(QDialog): # Similar to the above, but specific to the last round
-    def __init__(self, images):
+    def __init__(self, images, image_ids=None):
         super().__init__()
         self.setWindowTitle("Final results!")
         self.resize(1000, 800)
@@ -126,14 +252,14 @@ class ImageWindowRounds(QDialog): # Similar to the above, but specific to the la
         content_widget = QWidget()
         scroll_area.setWidget(content_widget)
         layout = QGridLayout(content_widget)
-        max_image_size = 320  # Adjust this value if need be
+        max_image_size = THUMBNAIL_SIZE  # Adjust this value if need be
 
         for index, image_data in enumerate(images):
             pixmap = QPixmap()
-            pixmap.loadFromData(base64.b64decode(image_data))
+            pixmap.loadFromData(image_data)
             scaled_pixmap = pixmap.scaled(max_image_size, max_image_size, Qt.KeepAspectRatio)
 
-            label = QLabel()
+            label = ResultLabel(image_ids[index] if image_ids else None)
             label.setPixmap(scaled_pixmap)
             layout.addWidget(label, index // 2, index % 2)  # Arrange images in a grid
         content_widget.setLayout(layout)
@@ -239,16 +365,57 @@ class ProgressDialog(QDialog): # The pop up
         layout = QVBoxLayout()
         self.label = QLabel("Training is currently in progress... Do not close")
         layout.addWidget(self.label)
+
+        # Results of the mazes that are already done
+        self.status = {}
+        self.eta = "" # Time the server expects the round to take
+        thumbnail_layout = QHBoxLayout()
+        self.thumbnails = [QLabel() for _ in range(4)]
+        for thumbnail in self.thumbnails:
+            thumbnail_layout.addWidget(thumbnail)
+        layout.addLayout(thumbnail_layout)
         self.setLayout(layout)
 
     def set_message(self, message):
         self.label.setText(message)
 
+    def show_event(self, event, image=None): # Progress streamed by the server while the round trains
+        kind = event.get("event")
+        if kind == "queued":
+            if "eta" in event:
+                self.eta = f"\nExpected to be done in about {max(1, round(event['eta'] / 60))} minutes"
+            if event.get("position", 0) > 1:
+                self.set_message(f"Waiting for the server, {event['position'] - 1} participants are ahead of you... Do not close" + self.eta)
+            else:
+                self.set_message("Training is currently in progress... Do not close" + self.eta)
+            return
+        if kind == "notice": # Something the server wants the participant to know, e.g. that the round moved elsewhere
+            self.set_message(event["message"] + "... Do not close" + self.eta)
+            return
+        if "index" not in event:
+            return
+        maze = event["index"] + 1
+        if kind == "maze_started":
+            self.status[maze] = "training"
+        elif kind == "eval":
+            self.status[maze] = f"reward {event['reward']:.2f} after {event['timestep']} steps"
+        elif kind == "maze_finished":
+            self.status[maze] = "done"
+        elif kind == "image" and image is not None: # Show each result as soon as it is there
+            pixmap = QPixmap()
+            pixmap.loadFromData(image)
+            self.thumbnails[event["index"]].setPixmap(pixmap.scaled(160, 160, Qt.KeepAspectRatio))
+        self.set_message("Training is currently in progress... Do not close" + self.eta + "\n"
+                         + "\n".join(f"Maze {m}: {text}" for m, text in sorted(self.status.items())))
+
 class MainWindow(QWidget): # Most important window
     def __init__(self):
         super().__init__()
         self.resize(1840, 980)
         self.round_count = 0  # Initialize count for experiment rounds.
+        self.selected_index = None  # Result picked in the previous round
+        self.previewer = MazePreviewer()
+        self.preview_timers = {}  # Maze widget -> timer that delays its preview while the settings change
 
         self.start_window = StartWindow() # Initialize the start up window
         self.start_window.exec_()
@@ -332,28 +499,29 @@ class MainWindow(QWidget): # Most important window
 	# Go over first layer of mazes
         for i, widgets in enumerate(self.variable_widgets1):
             if sender in widgets.values():
-                maze_widget = self.maze_widgets1[i]
-                maze_widget.set_maze(self._maze_data(
-                    widgets["Seed"].value(),
-                    widgets["Size"].value(),
-                    widgets["Traps"].value() / 100,
-                    widgets["Without intersections"].isChecked(),
-                    amaze.StartLocation[widgets["Start"].currentText()]
-                ))
+                self.schedule_preview(self.maze_widgets1[i], widgets)
                 return
 	# Go over last layer of mazes
         for i, widgets in enumerate(self.variable_widgets2):
             if sender in widgets.values():
-                maze_widget = self.maze_widgets2[i]
-                maze_widget.set_maze(self._maze_data(
-                    widgets["Seed"].value(),
-                    widgets["Size"].value(),
-                    widgets["Traps"].value() / 100,
-                    widgets["Without intersections"].isChecked(),
-                    amaze.StartLocation[widgets["Start"].currentText()]
-                ))
+                self.schedule_preview(self.maze_widgets2[i], widgets)
                 return
 
+    def schedule_preview(self, maze_widget, widgets): # Only the last of quick changes is generated
+        timer = self.preview_timers.get(maze_widget)
+        if timer is None:
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.timeout.connect(lambda: self.previewer.request(maze_widget, self._maze_data(
+                widgets["Seed"].value(),
+                widgets["Size"].value(),
+                widgets["Traps"].value() / 100,
+                widgets["Without intersections"].isChecked(),
+                amaze.StartLocation[widgets["Start"].currentText()]
+            )))
+            self.preview_timers[maze_widget] = timer
+        timer.start(PREVIEW_DELAY)
+
     # All data. If they do not show up in the interface, use default values.
     def _maze_data(self, seed, size, p_trap, easy, start):
         return amaze.Maze.BuildData(
@@ -408,59 +576,79 @@ class MainWindow(QWidget): # Most important window
             self.show_progress_dialog_rounds(maze_strings)
 
     def show_progress_dialog(self, maze_strings):
+        self.start_round(maze_strings, self.process_finished)
+
+    def show_progress_dialog_rounds(self, maze_strings): # Same as show_progress_dialog, but for the last round
+        self.start_round(maze_strings, self.rounds_finished, final=True)
+
+    def start_round(self, maze_strings, on_finished, final=False):
         self.setEnabled(False)  # Disable the MainWindow
         self.progress_dialog = ProgressDialog()
         self.progress_dialog.setWindowModality(Qt.WindowModal)
         self.progress_dialog.show()
-        response = send_to_server(self.participant_id, maze_strings)
-        if response:
-            try:
-                images = json.loads(response)
-                # Continue with the processing of images
-                self.process_finished(images, maze_strings)
-            except json.JSONDecodeError as e:
-                print("JSON decoding error:", e)
-                QMessageBox.warning(None, 'Error', "Failed to decode server response.")
+        self.pending_round = (maze_strings, on_finished)
+
+        # The connection runs in its own thread, its signals arrive here in the GUI thread
+        self.server_thread = QThread()
+        self.server_worker = ServerWorker(self.participant_id, maze_strings, self.selected_index, final,
+                                          self.round_count)
+        self.server_worker.moveToThread(self.server_thread)
+        self.server_thread.started.connect(self.server_worker.run)
+        self.server_worker.progress.connect(self.progress_dialog.show_event)
+        self.server_worker.finished.connect(self.server_response)
+        self.server_worker.error.connect(self.server_error)
+        self.server_worker.timeout.connect(self.server_timeout)
+        for signal in (self.server_worker.finished, self.server_worker.error, self.server_worker.timeout):
+            signal.connect(self.server_thread.quit)
+        self.server_thread.finished.connect(self.server_worker.deleteLater)
+        self.server_thread.start()
+
+    def server_response(self, response):
+        maze_strings, on_finished = self.pending_round
+        if response.get("status") == "queue_full":
+            self.server_busy(response.get("position"))
+        elif response.get("status") == "error":
+            self.round_failed(f"Training failed on the server: {response.get('message')}")
         else:
-            QMessageBox.warning(None, 'Error', "No response from server.")
-            self.setEnabled(True)  # Re-enable the MainWindow
+            # Continue with the processing of images
+            on_finished(response["images"], maze_strings, response.get("image_ids"))
+
+    def server_error(self, message):
+        self.round_failed("No response from server.")
+
+    def server_timeout(self):
+        self.round_failed("The server did not respond in time.")
+
+    def round_failed(self, message): # The same round can be submitted again
+        self.round_count -= 1
+        self.progress_dialog.accept()
+        QMessageBox.warning(None, 'Error', message)
+        self.setEnabled(True)  # Re-enable the MainWindow
+
+    def server_busy(self, position): # The server queue is full, the same round can be submitted again later
+        self.round_count -= 1
+        self.progress_dialog.accept()
+        QMessageBox.information(None, 'Server busy', f"The server is busy, {position} participants are waiting.\nPlease submit your mazes again in a few minutes.")
+        self.setEnabled(True)  # Re-enable the MainWindow
 
-    def process_finished(self, images, maze_strings):
+    def process_finished(self, images, maze_strings, image_ids=None):
         self.setEnabled(True)  # Re-enable the MainWindow
         self.progress_dialog.set_message("Finished training, let's see the results.")
         QTimer.singleShot(2000, self.progress_dialog.accept)
-        QTimer.singleShot(2000, lambda: self.show_images(images, maze_strings))
-
-    def show_progress_dialog_rounds(self, maze_strings): # Same as show_progress_dialog, but for the last round
-        self.setEnabled(False)  # Disable the MainWindow
-        self.progress_dialog = ProgressDialog()
-        self.progress_dialog.setWindowModality(Qt.WindowModal)
-        self.progress_dialog.show()
-        response = send_to_server(self.participant_id, maze_strings)
-        if response:
-            try:
-                images = json.loads(response)
-                # Continue with the processing of images
-                self.rounds_finished(images, maze_strings)
-            except json.JSONDecodeError as e:
-                print("JSON decoding error:", e)
-                QMessageBox.warning(None, 'Error', "Failed to decode server response.")
-        else:
-            QMessageBox.warning(None, 'Error', "No response from server.")
-            self.setEnabled(True)  # Re-enable the MainWindow
+        QTimer.singleShot(2000, lambda: self.show_images(images, maze_strings, image_ids))
 
-    def rounds_finished(self, images, maze_strings):  # Same as process_finished, but for the last round
+    def rounds_finished(self, images, maze_strings, image_ids=None):  # Same as process_finished, but for the last round
         self.setEnabled(True)  # Re-enable the MainWindow
         self.progress_dialog.set_message("Congrats, you are done. Here are your final results")
         QTimer.singleShot(2000, self.progress_dialog.accept)
-        QTimer.singleShot(2000, lambda: self.show_images_rounds(images))
+        QTimer.singleShot(2000, lambda: self.show_images_rounds(images, image_ids))
 
-    def show_images(self, images, maze_strings):
-        image_window = ImageWindow(images, maze_strings, self.update_maze_data)
+    def show_images(self, images, maze_strings, image_ids=None):
+        image_window = ImageWindow(images, maze_strings, self.update_maze_data, image_ids)
         image_window.exec_()
 
-    def show_images_rounds(self, images): # Same as show_images, but for the last round
-        image_window = ImageWindowRounds(images)
+    def show_images_rounds(self, images, image_ids=None): # Same as show_images, but for the last round
+        image_window = ImageWindowRounds(images, image_ids)
         image_window.exec_()
         self.start_end_window()
 
@@ -469,7 +657,8 @@ class MainWindow(QWidget): # Most important window
         self.end_window.exec_()
 	    
     # To updated mazes based on selected result
-    def update_maze_data(self, new_maze_string):
+    def update_maze_data(self, new_maze_string, selected_index=None):
+        self.selected_index = selected_index
         maze_data = new_maze_string
         self.update_mazes(maze_data)
 
@@ -479,12 +668,12 @@ class MainWindow(QWidget): # Most important window
         for widgets in self.variable_widgets1:
             maze_widget = self.maze_widgets1[self.variable_widgets1.index(widgets)]
             self.set_maze_widget_data(widgets, maze_data)
-            maze_widget.set_maze(self._maze_data_from_string_data(maze_data))
+            self.previewer.request(maze_widget, self._maze_data_from_string_data(maze_data))
 
         for widgets in self.variable_widgets2:
             maze_widget = self.maze_widgets2[self.variable_widgets2.index(widgets)]
             self.set_maze_widget_data(widgets, maze_data)
-            maze_widget.set_maze(self._maze_data_from_string_data(maze_data))
+            self.previewer.request(maze_widget, self._maze_data_from_string_data(maze_data))
 
     def set_maze_widget_data(self, widgets, data):
         #print("Setting maze widget data with:", data)
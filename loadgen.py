@@ -0,0 +1,134 @@
+import argparse
+import json
+import math
+import random
+import threading
+import time
+
+from protocol import make_request, request_round
+
+# Headless participants for sizing a server. Every participant plays a session like the interface does:
+# think, submit four mazes, wait for the results, pick one, until the last round.
+#   python loadgen.py --port 50000 --participants 8        (serverexample)
+#   python loadgen.py --port 10022 --participants 8        (socket2)
+
+HOST = 'localhost'
+PORT = 50000
+PARTICIPANTS = 4
+ROUNDS = 10 # Same as the interface, the last round asks for the timeline
+MAZES = 4 # Mazes per round, as in MainWindow
+THINK_TIME = 30 # Mean seconds a participant spends on the settings before submitting, exponentially distributed
+RETRY_TIME = 60 # Seconds before a round turned away with queue_full is submitted again
+TIMEOUT = 900
+SIZES = [5, 10, 15, 20]
+TRAPS = [0, 10, 30] # Percent, as the Traps spinbox
+STARTS = ["SOUTH_WEST", "SOUTH_EAST", "NORTH_EAST", "NORTH_WEST"]
+
+def random_settings(rng, sizes, traps):
+    # Same shape as the settings MainWindow.save_settings sends
+    return {"Seed": rng.randrange(1000), "Size": rng.choice(sizes), "Traps": rng.choice(traps),
+            "Without intersections": rng.random() < 0.5, "Start": rng.choice(STARTS)}
+
+def percentile(values, p):
+    # Nearest rank, values has to be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.rounds = [] # One entry per submitted round: participant, round, status, seconds
+
+    def record(self, **result):
+        with self.lock:
+            self.rounds.append(result)
+        print(f"{result['participant']} round {result['round']}: {result['status']} after {result['seconds']:.1f}s")
+
+    def participant(self, index):
+        args = self.args
+        rng = random.Random(args.seed * 1000 + index)
+        participant_id = f"{args.prefix}{index}"
+        selected = None
+        round_number = 1
+        while round_number <= args.rounds:
+            time.sleep(rng.expovariate(1 / args.think) if args.think > 0 else 0)
+            mazes = [random_settings(rng, args.sizes, args.traps) for _ in range(MAZES)]
+            data = make_request(participant_id, mazes, selected, round_number == args.rounds, round_number,
+                                args.thumbnail_size)
+            start = time.perf_counter()
+            try:
+                response = request_round(args.host, args.port, data, timeout=args.timeout)
+                status = response.get("status", "ok")
+            except Exception as e:
+                status = f"exception: {type(e).__name__}"
+            self.record(participant=participant_id, round=round_number, status=status,
+                        seconds=time.perf_counter() - start)
+            if status == "queue_full":
+                time.sleep(args.retry) # The participant submits the same round again later
+                continue
+            if status == "ok":
+                selected = rng.randrange(MAZES)
+            round_number += 1
+
+    def run(self):
+        start = time.perf_counter()
+        threads = []
+        for index in range(self.args.participants):
+            thread = threading.Thread(target=self.participant, args=(index,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(self.args.ramp) # Participants do not all start at the same moment
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, seconds):
+        latencies = sorted(r["seconds"] for r in self.rounds if r["status"] == "ok")
+        statuses = {}
+        for r in self.rounds:
+            statuses[r["status"]] = statuses.get(r["status"], 0) + 1
+        submitted = len(self.rounds)
+        return {
+            "participants": self.args.participants,
+            "seconds": seconds,
+            "submitted": submitted,
+            "completed": len(latencies),
+            "rounds_per_minute": len(latencies) / seconds * 60 if seconds else None,
+            "latency": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                        "p99": percentile(latencies, 99), "max": latencies[-1] if latencies else None},
+            "statuses": statuses,
+            "rejected_rate": statuses.get("queue_full", 0) / submitted if submitted else None,
+            "error_rate": (submitted - len(latencies) - statuses.get("queue_full", 0)) / submitted if submitted else None,
+            "rounds": self.rounds,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates participants against serverexample or socket2")
+    parser.add_argument('--host', type=str, default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--participants', type=int, default=PARTICIPANTS)
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--think', type=float, default=THINK_TIME, help='Mean think time in seconds, 0 for none')
+    parser.add_argument('--retry', type=float, default=RETRY_TIME, help='Seconds before resubmitting after queue_full')
+    parser.add_argument('--ramp', type=float, default=1.0, help='Seconds between the starts of the participants')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Maze sizes to pick from')
+    parser.add_argument('--traps', type=int, nargs='+', default=TRAPS, help='Trap percentages to pick from')
+    parser.add_argument('--thumbnail-size', type=int, default=320, help='As the interface asks for, 0 for full images')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prefix', type=str, default=f"load{int(time.time())}-", help='Start of the participant ids')
+    parser.add_argument('--output', type=str, default=None, help='JSON file the report is written to')
+    args = parser.parse_args()
+    args.thumbnail_size = args.thumbnail_size or None
+
+    report = LoadGenerator(args).run()
+    summary = {name: value for name, value in report.items() if name != "rounds"}
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import time
+
+# Stand-in for the SLURM commands socket2 uses, runs the jobs on this machine. Example:
+#   SBATCH="python local_sbatch.py sbatch" SACCT="python local_sbatch.py sacct" \
+#   SCANCEL="python local_sbatch.py scancel" python socket2.py
+# Supports the options socket2 passes: --parsable, --array=a-b, --dependency=afterok:id, --kill-on-invalid-dep
+# and --cpus-per-task. Other options are accepted and ignored.
+
+STATE_DIR = pathlib.Path(os.environ.get("LOCAL_SLURM_DIR", ".local_slurm"))
+FAILED_STATES = {"FAILED", "CANCELLED"}
+
+def state_file(job_id):
+    return STATE_DIR / f"{job_id}.json"
+
+def read_state(job_id):
+    try:
+        with open(state_file(job_id), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_state(job_id, **values):
+    state = read_state(job_id) or {}
+    state.update(values)
+    tmp_file = state_file(job_id).with_suffix(".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file(job_id))
+
+def parse_options(argv):
+    options = {}
+    i = 0
+    while i < len(argv) and argv[i].startswith("-"):
+        name, _, value = argv[i].lstrip("-").partition("=")
+        options[name] = value or True
+        i += 1
+    return options, argv[i], argv[i + 1:]
+
+def sbatch(argv):
+    options, script, args = parse_options(argv)
+    STATE_DIR.mkdir(exist_ok=True)
+    job_id = str(time.time_ns() // 1000 % 10 ** 10)
+
+    tasks = [None]
+    if "array" in options:
+        first, _, last = options["array"].partition("-")
+        tasks = list(range(int(first), int(last or first) + 1))
+    dependency = None
+    if "dependency" in options:
+        kind, _, dependency = options["dependency"].partition(":")
+        if kind != "afterok":
+            raise SystemExit(f"local_sbatch only supports afterok dependencies, got {kind}")
+
+    write_state(job_id, states=["PENDING"] * len(tasks))
+    spec = {"job_id": job_id, "script": script, "args": args, "tasks": tasks, "dependency": dependency,
+            "cpus": options.get("cpus-per-task", "1")}
+    runner = subprocess.Popen([sys.executable, os.path.abspath(__file__), "run", json.dumps(spec)],
+                              start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    write_state(job_id, pid=runner.pid)
+    print(job_id if "parsable" in options else f"Submitted batch job {job_id}")
+
+def run(spec):
+    # Runs detached from sbatch: waits for the dependency, then starts all tasks of the job at once
+    spec = json.loads(spec)
+    job_id = spec["job_id"]
+    tasks = spec["tasks"]
+    if spec["dependency"]:
+        while True:
+            dependency = read_state(spec["dependency"])
+            states = dependency["states"] if dependency else ["FAILED"]
+            if any(state in FAILED_STATES for state in states):
+                write_state(job_id, states=["CANCELLED"] * len(tasks))
+                return
+            if all(state == "COMPLETED" for state in states):
+                break
+            time.sleep(0.5)
+
+    write_state(job_id, states=["RUNNING"] * len(tasks))
+    processes = []
+    for task in tasks:
+        env = dict(os.environ, SLURM_JOB_ID=job_id, SLURM_CPUS_PER_TASK=str(spec["cpus"]))
+        name = job_id
+        if task is not None:
+            env.update(SLURM_ARRAY_JOB_ID=job_id, SLURM_ARRAY_TASK_ID=str(task))
+            name = f"{job_id}_{task}"
+        log = open(STATE_DIR / f"{name}.out", "w")
+        processes.append(subprocess.Popen(["bash", spec["script"], *spec["args"]], env=env,
+                                          stdout=log, stderr=subprocess.STDOUT))
+    codes = [process.wait() for process in processes]
+    write_state(job_id, states=["COMPLETED" if code == 0 else "FAILED" for code in codes])
+
+def sacct(argv):
+    # Only "sacct -j <id> ..." is supported, prints one state per task
+    state = read_state(argv[argv.index("-j") + 1])
+    if state is not None:
+        print("\n".join(state["states"]))
+
+def scancel(argv):
+    for job_id in argv:
+        state = read_state(job_id)
+        if state is None:
+            continue
+        try:
+            os.killpg(state["pid"], signal.SIGTERM)
+        except (KeyError, ProcessLookupError, PermissionError):
+            pass
+        write_state(job_id, states=["CANCELLED"] * len(state["states"]))
+
+if __name__ == "__main__":
+    command = {"sbatch": sbatch, "run": lambda argv: run(argv[0]), "sacct": sacct, "squeue": sacct,
+               "scancel": scancel}[sys.argv[1]]
+    command(sys.argv[2:])
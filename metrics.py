@@ -0,0 +1,83 @@
+import contextlib
+import http.server
+import json
+import os
+import threading
+import time
+
+# Timings of the stages of a round. Every measurement is appended to METRICS_FILE as one JSON line,
+# tagged with the participant, round and maze it belongs to. The totals per stage are also served in the
+# Prometheus text format on a side port, see serve_metrics.
+METRICS_FILE = os.environ.get("METRICS_FILE", "results/metrics.jsonl")
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600) # Upper bounds in seconds of the histogram
+
+_lock = threading.Lock()
+_stages = {} # Stage -> [count per bucket, count, sum of seconds]
+_file = None
+
+def record(stage, seconds, **tags):
+    global _file
+    line = json.dumps(dict(time=time.time(), stage=stage, seconds=seconds, pid=os.getpid(), **tags), default=str)
+    with _lock:
+        buckets, count, total = _stages.get(stage, ([0] * len(BUCKETS), 0, 0.0))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        _stages[stage] = (buckets, count + 1, total + seconds)
+        if METRICS_FILE:
+            if _file is None:
+                os.makedirs(os.path.dirname(METRICS_FILE) or ".", exist_ok=True)
+                _file = open(METRICS_FILE, "a", buffering=1)
+            _file.write(line + "\n")
+
+@contextlib.contextmanager
+def timer(stage, **tags):
+    # with timer("learn", participant=..., maze=...): records how long the block took, also when it raises
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, **tags)
+
+def record_training(stats, **tags):
+    # Records the stages of a training, stats is the dictionary train() returns
+    for stage in ("env", "learn", "render", "image"):
+        if stage in stats:
+            record(stage, stats[stage], **tags)
+    for seconds in stats.get("evals", ()):
+        record("eval", seconds, **tags)
+
+def prometheus_text():
+    lines = ["# HELP amaze_stage_seconds Time spent in the stages of a round",
+             "# TYPE amaze_stage_seconds histogram"]
+    with _lock:
+        stages = {stage: (list(buckets), count, total) for stage, (buckets, count, total) in _stages.items()}
+    for stage, (buckets, count, total) in sorted(stages.items()):
+        for bound, n in zip(BUCKETS, buckets):
+            lines.append(f'amaze_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {n}')
+        lines.append(f'amaze_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'amaze_stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'amaze_stage_seconds_count{{stage="{stage}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # Scrapes are not worth a line in the server output
+        pass
+
+def serve_metrics(port, host="0.0.0.0"):
+    # Serves GET /metrics from a background thread, returns the server
+    server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
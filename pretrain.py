@@ -0,0 +1,99 @@
+import argparse
+import concurrent.futures
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+
+import training
+from result_cache import ResultCache, cache_key
+
+# Trains a grid of maze settings ahead of time. The results go into a library with the same layout and keys as
+# the result cache, which the servers check before training. Mazes that match are answered without training.
+#   python pretrain.py --sizes 5 6 7 8 --seeds 0-9
+# The library is only valid for the training settings (BUDGET, SEED, ROBOT, HYPERPARAMS) of the target server.
+
+STARTS = ["SOUTH_WEST", "SOUTH_EAST", "NORTH_EAST", "NORTH_WEST"]
+
+def int_range(text):
+    # "3" -> [3], "0-9" -> [0, ..., 9]
+    first, _, last = text.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+def grid(seeds, sizes, traps, unicursive, starts):
+    # Settings in the shape the interface sends, so make_string turns them into the same maze strings
+    for seed, size, trap, easy, start in itertools.product(seeds, sizes, traps, unicursive, starts):
+        yield {"Seed": seed, "Size": size, "Traps": trap, "Without intersections": easy, "Start": start}
+
+def write_index(library, entries):
+    # index.json lists the settings of every maze in the library, by key
+    index_path = library.root / "index.json"
+    index = {}
+    if index_path.exists():
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    index.update(entries)
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Trains a grid of maze settings into the library")
+    parser.add_argument('--target', type=str, default="serverexample", choices=["serverexample", "worker2"],
+                        help='Server whose training settings are used')
+    parser.add_argument('--library', type=str, default=training.LIBRARY_DIR)
+    parser.add_argument('--seeds', type=int_range, default=int_range("0-9"), help='Range of seeds, e.g. 0-9')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 6, 7, 8, 9, 10])
+    parser.add_argument('--traps', type=float, nargs='+', default=[0.0], help='Values of the Traps spinbox')
+    parser.add_argument('--unicursive', type=int, nargs='+', default=[1, 0], choices=[0, 1])
+    parser.add_argument('--starts', type=str, nargs='+', default=STARTS, choices=STARTS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Parallel trainings')
+    args = parser.parse_args()
+
+    server = importlib.import_module(args.target) # Sets the training settings of the target in training.py
+    library = ResultCache(args.library, max_bytes=None)
+    work_dir = library.root / ".work"
+
+    # Maze strings by key, mazes already in the library are skipped
+    todo = {}
+    p_traps = {}
+    index = {}
+    for settings in grid(args.seeds, args.sizes, args.traps, [bool(u) for u in args.unicursive], args.starts):
+        simple_str = training.make_string([settings])[0]
+        p_trap = training.trap_probabilities([settings])[0]
+        key = cache_key(simple_str, training.ROBOT, training.SEED, training.BUDGET, training.training_params(p_trap))
+        index[key] = dict(settings, maze=simple_str)
+        if library.get(key) is None:
+            todo[key] = simple_str
+            p_traps[key] = p_trap
+    print(f"{len(index)} mazes in the grid, {len(index) - len(todo)} already in the library, training {len(todo)}")
+
+    # Same kind of training processes as the server uses
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=training._init_worker,
+                                                initargs=(server.TORCH_THREADS, args.target)) as pool:
+        futures = {}
+        for key, simple_str in todo.items():
+            (work_dir / key).mkdir(parents=True, exist_ok=True)
+            futures[pool.submit(training.train, simple_str, str(work_dir / key), p_trap=p_traps[key])] = key
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            key = futures[future]
+            try:
+                _, stats = future.result()
+            except Exception as e:
+                print(f"Training of {todo[key]} failed: {e}")
+                continue
+            training.cost_model.record_training(training.Maze.BuildData.from_string(todo[key]), False, stats,
+                                                p_traps[key])
+            library.put(key, work_dir / key)
+            shutil.rmtree(work_dir / key, ignore_errors=True)
+            print(f"[{done}/{len(todo)}] Added {todo[key]} to the library")
+
+    write_index(library, {key: value for key, value in index.items() if library.get(key) is not None})
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
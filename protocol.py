@@ -0,0 +1,168 @@
+import base64
+import json
+import socket
+import struct
+
+# Every frame starts with a fixed header: magic, protocol version, frame type and payload length.
+# Images are sent as raw PNG bytes in their own frames, so no base64 is needed.
+MAGIC = b"AMZE"
+VERSION = 1
+HEADER = struct.Struct("!4sBBI")
+IMAGE_INDEX = struct.Struct("!H") # Image frames start with the index of the maze they belong to
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+JSON_FRAME = 1 # Request, status messages
+IMAGE_FRAME = 2 # Index followed by the image bytes
+END_FRAME = 3 # Last frame of a response
+EVENT_FRAME = 4 # Progress of the training, sent while the round is running
+
+BUFFER_SIZE = 65536
+LEGACY_MAX_SIZE = 1024 * 1024 # Requests of old clients are single JSON objects without framing
+
+class ProtocolError(Exception):
+    pass
+
+def pack_frame(frame_type, payload=b""):
+    return HEADER.pack(MAGIC, VERSION, frame_type, len(payload)) + payload
+
+def pack_json(data):
+    return pack_frame(JSON_FRAME, json.dumps(data).encode())
+
+def pack_image(index, image_bytes):
+    return pack_frame(IMAGE_FRAME, IMAGE_INDEX.pack(index) + image_bytes)
+
+def pack_event(event):
+    return pack_frame(EVENT_FRAME, json.dumps(event).encode())
+
+def image_parts(index, image_bytes):
+    # Same as pack_image, but without copying the image into a new buffer
+    return [HEADER.pack(MAGIC, VERSION, IMAGE_FRAME, IMAGE_INDEX.size + len(image_bytes)),
+            IMAGE_INDEX.pack(index), image_bytes]
+
+def unpack_image(payload):
+    (index,) = IMAGE_INDEX.unpack_from(payload)
+    return index, payload[IMAGE_INDEX.size:]
+
+def unpack_header(header):
+    magic, version, frame_type, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Not a framed message")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes is too large")
+    return frame_type, length
+
+# Blocking sockets, used by the interface
+
+def recv_exactly(sock, size):
+    # recv may return less than asked for, keep reading until the whole frame is there
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        received += n
+    return bytes(buffer)
+
+def recv_frame(sock):
+    frame_type, length = unpack_header(recv_exactly(sock, HEADER.size))
+    return frame_type, recv_exactly(sock, length)
+
+def send_frame(sock, frame_type, payload=b""):
+    sock.sendall(pack_frame(frame_type, payload))
+
+def make_request(participant_id=None, maze_strings=None, selected=None, final=False, round_number=None,
+                 thumbnail_size=None):
+    # Combine participant ID and maze_strings into one JSON object.
+    # maze_strings are the settings of the mazes as MainWindow.save_settings collects them.
+    return {
+        "participant_id": participant_id,
+        "maze_data": maze_strings,
+        "selected": selected, # Index of the result picked last round, the server continues training from it
+        "final": final, # Last round, the server then composes the timeline of the session
+        "round": round_number, # Only used to tag the timings on the server
+        "thumbnail_size": thumbnail_size # Results are sent as thumbnails of this size, None for the full images
+    }
+
+def request_round(host, port, data, timeout=None, on_event=None):
+    # Sends a round and waits for the complete response.
+    # Returns the status message of the server with the images added as a list of bytes, ordered by maze index.
+    # on_event(event, image=None) is called for every progress event and image while the round is running.
+    with socket.create_connection((host, port), timeout=timeout) as client_socket:
+        client_socket.sendall(pack_json(data))
+        response = {"status": "ok"}
+        images = {}
+        while True:
+            frame_type, payload = recv_frame(client_socket)
+            if frame_type == JSON_FRAME:
+                response.update(json.loads(payload))
+            elif frame_type == EVENT_FRAME:
+                if on_event is not None:
+                    on_event(json.loads(payload))
+            elif frame_type == IMAGE_FRAME:
+                index, image_bytes = unpack_image(payload)
+                images[index] = image_bytes
+                if on_event is not None:
+                    on_event({"event": "image", "index": index}, image_bytes)
+            elif frame_type == END_FRAME:
+                break
+            else:
+                raise ProtocolError(f"Unknown frame type {frame_type}")
+    response["images"] = [images[i] for i in sorted(images)]
+    return response
+
+def fetch_image(host, port, image_id, timeout=None):
+    # Asks for the full resolution image of a thumbnail, returns the image bytes or None if the server no longer has it
+    response = request_round(host, port, {"image_id": image_id}, timeout=timeout)
+    if response.get("status") != "ok" or not response["images"]:
+        return None
+    return response["images"][0]
+
+# asyncio streams, used by the servers
+
+async def read_frame(reader):
+    frame_type, length = unpack_header(await reader.readexactly(HEADER.size))
+    return frame_type, await reader.readexactly(length)
+
+async def read_request(reader):
+    # Returns the request and whether the client speaks the framed protocol.
+    # Old clients send one JSON object and wait for a JSON answer, they are still understood.
+    start = await reader.readexactly(len(MAGIC))
+    if start == MAGIC:
+        rest = await reader.readexactly(HEADER.size - len(MAGIC))
+        frame_type, length = unpack_header(start + rest)
+        if frame_type != JSON_FRAME:
+            raise ProtocolError(f"Expected a request, got frame type {frame_type}")
+        return json.loads(await reader.readexactly(length)), True
+
+    data = start
+    while True:
+        try:
+            return json.loads(data.decode()), False
+        except ValueError: # Not complete yet
+            if len(data) > LEGACY_MAX_SIZE:
+                raise ProtocolError("Request is too large")
+        chunk = await reader.read(BUFFER_SIZE)
+        if not chunk:
+            raise ConnectionError("Connection closed before the request was complete")
+        data += chunk
+
+def encode_response(images, framed, status=None, skip=()):
+    # Builds a complete response in the protocol the client used, as a list of buffers for writer.writelines.
+    # Image bytes are passed on as they are, only the small headers are new.
+    # Indices in skip were already streamed to the client.
+    if not framed:
+        if status is not None:
+            return [json.dumps(status).encode()]
+        return [json.dumps([base64.b64encode(image).decode('utf-8') for image in images]).encode()]
+    parts = []
+    if status is not None:
+        parts.append(pack_json(status))
+    for index, image in enumerate(images):
+        if index not in skip:
+            parts.extend(image_parts(index, image))
+    parts.append(pack_frame(END_FRAME))
+    return parts
@@ -0,0 +1,115 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+import uuid
+
+CACHE_DIR = "results/cache"
+CACHE_MAX_BYTES = 2 * 1024 ** 3 # Size bound of the cache on disk, least recently used entries are removed first
+CACHE_FILES = ["best_model.zip", "trajectories/eval_final.png"] # Files of a training folder kept in the cache
+
+def cache_key(simple_str, robot_str, seed, budget, hyperparams):
+    # Everything that changes the outcome of train() has to be part of the key
+    data = json.dumps([simple_str, robot_str, seed, budget, hyperparams], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def file_digest(path):
+    # Used to key results that depend on a file, such as the model a training was warm started from
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _folder_size(folder):
+    return sum(f.stat().st_size for f in folder.rglob("*") if f.is_file())
+
+class InFlight:
+    # Trainings running in this process, by cache key. A round that needs a training that another round is
+    # already running waits for its result instead of training the same maze again.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def claim(self, key):
+        # Returns the future of the training and whether the caller is the one that has to run it
+        with self.lock:
+            if key in self.futures:
+                return self.futures[key], False
+            future = self.futures[key] = concurrent.futures.Future()
+            return future, True
+
+    def release(self, key, future, result=None, error=None):
+        # Called by the round that claimed the training, with its result or the error it failed with
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class ResultCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns the folder of the entry, or None on a miss. A hit marks the entry as recently used.
+        entry = self.root / key
+        if not (entry / CACHE_FILES[-1]).exists():
+            return None
+        if self.max_bytes is None: # Nothing is evicted, so there is no need to track use
+            return entry
+        try:
+            os.utime(entry)
+        except FileNotFoundError: # Evicted by another process in the meantime
+            return None
+        return entry
+
+    def put(self, key, folder):
+        # Copies the results of a training folder into the cache. Returns the entry, or None if the training left no image.
+        folder = pathlib.Path(folder)
+        if not (folder / CACHE_FILES[-1]).exists():
+            return None
+        entry = self.root / key
+
+        # Write into a temporary folder first, so other processes never see a half written entry
+        tmp = self.root / f".tmp-{uuid.uuid4().hex}"
+        for name in CACHE_FILES:
+            if (folder / name).exists():
+                (tmp / name).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(folder / name, tmp / name)
+        try:
+            os.rename(tmp, entry)
+        except OSError: # Entry already stored by someone else, keep theirs
+            shutil.rmtree(tmp, ignore_errors=True)
+        os.utime(entry)
+
+        self.evict()
+        return entry
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            entries = []
+            for entry in self.root.iterdir():
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, _folder_size(entry), entry))
+                except FileNotFoundError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            # Oldest access time first
+            for mtime, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                print(f"Evicted cache entry {entry.name} (last used {time.ctime(mtime)})")
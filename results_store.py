@@ -0,0 +1,202 @@
+import contextlib
+import json
+import os
+import pathlib
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+# Folders of the trainings. Every training gets a folder named by a short random id, results/runs/ab/ab12cd34ef56,
+# which is written under results/runs/.tmp and moved into place once the training is done, so a folder in place
+# is always complete. An SQLite index records whose run it is and whether it is still needed:
+#   training  still being written
+#   done      result of the last round of a participant, who has not picked one yet
+#   selected  picked by the participant, its model is kept for warm starts
+#   final     result of the last round of a session, its image is kept
+#   expired   not picked, removed after EXPIRE_SECONDS
+# collect() removes expired runs and prunes kept runs to KEEP_FILES, servers run it every GC_INTERVAL seconds.
+# Without a server running it (worker2 in one-shot jobs), run python results_store.py from time to time.
+# SQLite on a shared file system does not cope with writers on several nodes, so only one process, the server, writes
+# the index. The worker processes use a store with index=False, which writes every change (create, commit, mark) to
+# a file in .changes instead. ingest() applies them to the index in the order they were made, the server calls it
+# after each round and before every collect().
+STORE_DIR = os.environ.get("RESULTS_STORE", "results/runs")
+ID_LENGTH = 12 # Hex digits of a run id
+KEEP_ALL = False # Keep every file of every run, nothing is collected
+KEEP_FILES = {"selected": ["best_model.zip", "trajectories/eval_final.png"],
+              "final": ["trajectories/eval_final.png"]} # Files a run keeps once it is pruned, by status
+EXPIRE_SECONDS = 3600 # Grace time before expired runs are removed and kept runs pruned, rounds may still read them
+ABANDONED_SECONDS = 24 * 3600 # Runs of sessions that did not continue, and trainings that never finished
+GC_INTERVAL = 600
+
+class ResultsStore:
+    def __init__(self, root=STORE_DIR, index=True):
+        self.root = pathlib.Path(root)
+        self.tmp = self.root / ".tmp"
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        self.changes = self.root / ".changes"
+        self.changes.mkdir(exist_ok=True)
+        self.index = index
+        self.ingest_lock = threading.Lock() # Applies the changes of one ingest() after those of the previous one
+        self.index_path = self.root / "index.sqlite"
+        if not index:
+            return
+        with self._db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS runs (id TEXT PRIMARY KEY, participant TEXT, maze TEXT, "
+                       "status TEXT, created REAL, updated REAL, pruned INTEGER DEFAULT 0)")
+            db.execute("CREATE INDEX IF NOT EXISTS runs_status ON runs (status, updated)")
+
+    @contextlib.contextmanager
+    def _db(self):
+        # A connection per use, so the store can be used from any thread. Commits when the block succeeds.
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def folder(self, run_id):
+        return self.root / run_id[:2] / run_id
+
+    def _run_id(self, folder):
+        # Id of a folder of this store, None for other folders such as cache entries
+        folder = pathlib.Path(folder).resolve()
+        root = self.root.resolve()
+        if folder.parent.parent == root or folder.parent == self.tmp.resolve():
+            return folder.name
+        return None
+
+    def create(self, participant_id, maze):
+        # Returns the folder a training writes into
+        while True:
+            run_id = uuid.uuid4().hex[:ID_LENGTH]
+            if self.folder(run_id).exists():
+                continue
+            try:
+                (self.tmp / run_id).mkdir()
+                break
+            except FileExistsError:
+                continue
+        self._record(dict(action="create", id=run_id, participant=participant_id, maze=maze, time=time.time()))
+        return str(self.tmp / run_id)
+
+    def commit(self, folder):
+        # Moves the folder of a finished training into place, returns where it is now
+        run_id = pathlib.Path(folder).name
+        target = self.folder(run_id)
+        target.parent.mkdir(exist_ok=True)
+        os.rename(folder, target)
+        self._record(dict(action="commit", id=run_id, time=time.time()))
+        return str(target)
+
+    def mark(self, folders, status):
+        # Sets the status of the runs among folders, other folders are ignored. final is kept for good.
+        run_ids = [run_id for run_id in (self._run_id(folder) for folder in folders) if run_id is not None]
+        if self.index:
+            self.ingest() # The runs of the workers may only be in their changes yet
+        if run_ids:
+            self._record(dict(action="mark", ids=run_ids, status=status, time=time.time()))
+
+    def collect(self):
+        # Removes what the retention settings no longer keep, returns the number of runs removed and pruned
+        self.ingest()
+        if KEEP_ALL:
+            return 0, 0
+        now = time.time()
+        with self._db() as db:
+            remove = db.execute("SELECT id, status FROM runs WHERE (status = 'expired' AND updated < ?) "
+                                "OR (status IN ('training', 'done') AND updated < ?)",
+                                (now - EXPIRE_SECONDS, now - ABANDONED_SECONDS)).fetchall()
+            prune = db.execute("SELECT id, status FROM runs WHERE status IN ('selected', 'final') AND pruned = 0 "
+                               "AND updated < ?", (now - EXPIRE_SECONDS,)).fetchall()
+        for run_id, status in remove:
+            shutil.rmtree(self.tmp / run_id if status == "training" else self.folder(run_id), ignore_errors=True)
+            with self._db() as db:
+                db.execute("DELETE FROM runs WHERE id = ? AND status = ?", (run_id, status))
+        for run_id, status in prune:
+            _prune(self.folder(run_id), KEEP_FILES[status])
+            with self._db() as db:
+                db.execute("UPDATE runs SET pruned = 1 WHERE id = ? AND status = ?", (run_id, status))
+        if remove or prune:
+            print(f"Results store: removed {len(remove)} runs, pruned {len(prune)}")
+        return len(remove), len(prune)
+
+    def _record(self, change):
+        # Applies a change to the index, or leaves it in a file for ingest() without the index
+        if self.index:
+            with self._db() as db:
+                _apply(db, change)
+            return
+        # Named by time, so ingest() applies the changes in order. Written to a temporary file first, so ingest()
+        # never reads half a change.
+        path = self.changes / f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(change, f)
+        os.replace(tmp_path, path)
+
+    def ingest(self):
+        # Applies the changes of the workers to the index and removes them. Each change is renamed before it is
+        # read, so when several processes ingest at the same time every change is applied once.
+        with self.ingest_lock:
+            claimed = []
+            for path in sorted(self.changes.glob("*.json")):
+                claim = path.with_suffix(f".{socket.gethostname()}-{os.getpid()}.ingesting")
+                try:
+                    os.rename(path, claim)
+                except FileNotFoundError: # Taken by another process
+                    continue
+                claimed.append(claim)
+            if claimed:
+                with self._db() as db:
+                    for claim in claimed:
+                        with open(claim, "r") as f:
+                            _apply(db, json.load(f))
+            for claim in claimed:
+                claim.unlink(missing_ok=True)
+            return len(claimed)
+
+    def start_collector(self, interval=GC_INTERVAL):
+        # Runs collect() every interval seconds in a background thread
+        def run():
+            while True:
+                try:
+                    self.collect()
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(interval)
+        threading.Thread(target=run, daemon=True).start()
+
+def _apply(db, change):
+    # Writes a change of create(), commit() or mark() to the index
+    if change["action"] == "create":
+        db.execute("INSERT INTO runs (id, participant, maze, status, created, updated) "
+                   "VALUES (?, ?, ?, 'training', ?, ?) ON CONFLICT (id) DO NOTHING",
+                   (change["id"], change["participant"], change["maze"], change["time"], change["time"]))
+    elif change["action"] == "commit":
+        db.execute("UPDATE runs SET status = 'done', updated = ? WHERE id = ?", (change["time"], change["id"]))
+    elif change["action"] == "mark":
+        db.executemany("UPDATE runs SET status = ?, updated = ?, pruned = 0 WHERE id = ? "
+                       "AND status NOT IN ('training', 'final')",
+                       [(change["status"], change["time"], run_id) for run_id in change["ids"]])
+
+def _prune(folder, keep):
+    # Removes every file of folder except those in keep, then the folders left empty
+    if not folder.is_dir():
+        return
+    for path in sorted(folder.rglob("*"), key=lambda p: len(p.parts), reverse=True):
+        if path.is_dir():
+            with contextlib.suppress(OSError): # Not empty
+                path.rmdir()
+        elif path.relative_to(folder).as_posix() not in keep:
+            path.unlink(missing_ok=True)
+
+if __name__ == "__main__":
+    # python results_store.py [STORE_DIR]: one collection, for deployments without a server running it
+    ResultsStore(sys.argv[1] if len(sys.argv) > 1 else STORE_DIR).collect()
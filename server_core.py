@@ -0,0 +1,244 @@
+import asyncio
+import concurrent.futures
+import time
+import traceback
+
+import metrics
+
+from protocol import encode_response, pack_event, image_parts
+from image_variants import ImageStore, make_thumbnail
+
+AGING = 1.0 # Seconds of predicted cost a waiting round gains per second it waits, see RoundQueue
+HEARTBEAT = 60 # Seconds without progress after which the client is told the round is still waiting, below its TIMEOUT
+
+full_images = ImageStore() # Full resolution images of the rounds sent as thumbnails, fetched by id
+
+class QueueFull(Exception):
+    def __init__(self, position):
+        super().__init__(f"Queue is full, {position} rounds are waiting")
+        self.position = position
+
+class RoundQueue:
+    # Bounded queue of rounds in front of a fixed number of training slots. Each server sets slots and max_waiting
+    # from its own TRAINING_SLOTS and QUEUE_SIZE.
+    # process_round is a blocking function, it runs in a thread so the event loop keeps accepting connections.
+    # cost predicts the seconds of a round from the arguments of submit, it is used for the ETA of the rounds.
+    # With shortest_first the round with the lowest cost goes first instead of the oldest one. Waiting lowers
+    # the cost by AGING seconds per second, so long rounds are not starved.
+    def __init__(self, process_round, slots, max_waiting, cost=None, shortest_first=False):
+        self.process_round = process_round
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self.cost = cost
+        self.shortest_first = shortest_first and cost is not None
+        self.pending = [] # Rounds waiting for a slot: (args, future, queued, tags, cost)
+        self.running = {} # Future -> (started, cost) of the rounds in a slot
+        self.available = asyncio.Semaphore(0) # One release per pending round
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=slots)
+        self.workers = []
+
+    def start(self):
+        for _ in range(self.slots):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    def waiting(self):
+        return len(self.pending)
+
+    def position(self, future):
+        # Position of the round of future in the queue, None once it got a slot
+        for position, item in enumerate(self._order(), 1):
+            if item[1] is future:
+                return position
+        return None
+
+    def cancel(self, future):
+        # Drops a round whose client went away. A round still waiting never gets a slot, a running one finishes
+        # but its result is dropped.
+        self.pending = [item for item in self.pending if item[1] is not future]
+        future.cancel()
+
+    def _order(self):
+        # Pending rounds in the order they will get a slot
+        if not self.shortest_first:
+            return list(self.pending)
+        now = time.perf_counter()
+        return sorted(self.pending, key=lambda item: item[4] - AGING * (now - item[2]))
+
+    def submit(self, *args, tags=None):
+        # Returns the position in the queue and a future for the result, raises QueueFull instead of waiting.
+        # tags are added to the time the round waited in the metrics.
+        if len(self.pending) >= self.max_waiting:
+            raise QueueFull(len(self.pending))
+        future = asyncio.get_running_loop().create_future()
+        cost = None
+        if self.cost is not None:
+            try:
+                cost = self.cost(*args)
+            except Exception:
+                traceback.print_exc() # A round that cannot be estimated is still trained
+        item = (args, future, time.perf_counter(), tags or {}, cost if cost is not None else 0)
+        self.pending.append(item)
+        self.available.release()
+        return self._order().index(item) + 1, future
+
+    def eta(self, future):
+        # Predicted seconds until the round of future is done, None without a cost function
+        if self.cost is None:
+            return None
+        now = time.perf_counter()
+        busy = sum(max(0, cost - (now - started)) for started, cost in self.running.values())
+        for item in self._order():
+            if item[1] is future:
+                return busy / self.slots + item[4]
+            busy += item[4]
+        if future in self.running:
+            started, cost = self.running[future]
+            return max(0, cost - (now - started))
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.available.acquire()
+            if not self.pending: # The round of this release was cancelled
+                continue
+            item = self._order()[0]
+            self.pending.remove(item)
+            args, future, queued, tags, cost = item
+            try:
+                if not future.cancelled():
+                    metrics.record("queue_wait", time.perf_counter() - queued, **tags)
+                    self.running[future] = (time.perf_counter(), cost)
+                    result = await loop.run_in_executor(self.executor, self.process_round, *args)
+                    if not future.cancelled():
+                        future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.running.pop(future, None)
+
+async def run_round(writer, round_queue, received_data, framed, reader=None):
+    # Queues the round and streams its progress to the client until the result is there.
+    # Clients of the old protocol only get the result. The round is cancelled when the client closes the connection,
+    # which is noticed on reader, as clients send nothing after their request.
+    participant_id = received_data.get("participant_id")
+    tags = {"participant": participant_id, "round": received_data.get("round")}
+    thumbnail_size = received_data.get("thumbnail_size") if framed else None
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    async def variant(image):
+        # Returns what is sent for an image: the image itself, or a thumbnail and the id of the full image
+        if thumbnail_size is None:
+            return image, None
+        start = time.perf_counter()
+        thumbnail = await loop.run_in_executor(None, make_thumbnail, image, thumbnail_size)
+        metrics.record("thumbnail", time.perf_counter() - start, **tags)
+        return thumbnail, full_images.put(image)
+
+    def progress(event, image=None): # Called from the training thread
+        loop.call_soon_threadsafe(events.put_nowait, (event, image))
+
+    try:
+        position, result = round_queue.submit(received_data, progress, tags=tags)
+    except QueueFull as e:
+        # Turn the round away instead of overloading the server, the interface asks to try again later
+        print(f"Rejected participant {participant_id}: {e}")
+        writer.writelines(encode_response([], framed, {"status": "queue_full", "position": e.position}))
+        await writer.drain()
+        return
+    eta = round_queue.eta(result)
+    print(f"Participant {participant_id} is queued at position {position}"
+          + (f", expected to be done in {eta:.0f}s" if eta is not None else ""))
+    if framed:
+        queued = {"event": "queued", "position": position}
+        if eta is not None:
+            queued["eta"] = eta
+        writer.write(pack_event(queued))
+        await writer.drain()
+
+    streamed = set()
+    image_ids = {}
+    closed = asyncio.ensure_future(reader.read(1)) if reader is not None else None
+    try:
+        while not result.done() or not events.empty():
+            if events.empty():
+                next_event = asyncio.ensure_future(events.get())
+                waiting = {next_event, result} | ({closed} if closed is not None else set())
+                await asyncio.wait(waiting, timeout=HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    if closed is not None and closed.done():
+                        raise ConnectionError("Client closed the connection")
+                    if framed and not result.done():
+                        # Waiting in the queue or for the scheduler, the client would otherwise give up on the round
+                        position = round_queue.position(result)
+                        heartbeat = {"event": "queued", "position": position} if position else {"event": "heartbeat"}
+                        eta = round_queue.eta(result)
+                        if eta is not None:
+                            heartbeat["eta"] = eta
+                        writer.write(pack_event(heartbeat))
+                        await writer.drain()
+                    continue
+                event, image = next_event.result()
+            else:
+                event, image = events.get_nowait()
+            if framed:
+                if image is not None:
+                    image, key = await variant(image)
+                    if key is not None:
+                        event = dict(event, image_id=key)
+                writer.write(pack_event(event))
+                if image is not None:
+                    writer.writelines(image_parts(event["index"], image))
+                    streamed.add(event["index"])
+                    image_ids[event["index"]] = event.get("image_id")
+                await writer.drain()
+    except ConnectionError:
+        # Nobody is waiting for the result anymore, a round submitted again does not train twice
+        print(f"Participant {participant_id} disconnected, their round is cancelled")
+        round_queue.cancel(result)
+        raise
+    finally:
+        if closed is not None:
+            closed.cancel()
+
+    try:
+        images = result.result()
+    except Exception as e:
+        traceback.print_exc()
+        writer.writelines(encode_response([], framed, {"status": "error", "message": str(e)}))
+        await writer.drain()
+        return
+
+    status = None
+    if thumbnail_size is not None:
+        sent = []
+        for index, image in enumerate(images):
+            if index in streamed:
+                sent.append(None) # Skipped by encode_response
+            else:
+                image, image_ids[index] = await variant(image)
+                sent.append(image)
+        images = sent
+        status = {"status": "ok", "image_ids": [image_ids[index] for index in range(len(images))]}
+    start = time.perf_counter()
+    writer.writelines(encode_response(images, framed, status, skip=streamed))
+    await writer.drain()
+    metrics.record("send", time.perf_counter() - start, **tags)
+
+async def send_full_image(writer, key, framed):
+    # Answers a request for the full resolution image of a thumbnail sent earlier
+    image = full_images.get(key)
+    if image is None:
+        writer.writelines(encode_response([], framed, {"status": "not_found", "image_id": key}))
+    else:
+        writer.writelines(encode_response([image], framed, {"status": "ok", "image_id": key}))
+    await writer.drain()
+
+async def serve(handle_client_connection, host, port):
+    server = await asyncio.start_server(handle_client_connection, host, port)
+    print(f"Server is listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
@@ -1,69 +1,273 @@
 import json
-import socket
+import base64
+import asyncio
+import functools
 import subprocess
-import threading
 import os
+import pathlib
 import time
+import queue
+import shlex
+import socket
+import threading
+import uuid
+
+import server_core
+import metrics
+from server_core import RoundQueue, run_round, send_full_image
+from protocol import read_request
+from cost_model import CostModel
+from results_store import ResultsStore
 
-BUFFER_SIZE = 4096
 HOST = 'localhost' # If hosted on a ripper with the interface elsewhere, use tunnelforwarding instead of solely the socket connection.
 PORT = 10022  # Choose any port number that is not already in use
+TRAINING_SLOTS = 4 # SLURM jobs submitted at the same time
+# Rounds in different slots are separate jobs that do not know of each other: a maze submitted by several of them
+# at once is trained by each. Only mazes whose training finished before a job looks them up come from the result cache.
+QUEUE_SIZE = 16 # Rounds that may wait for a slot, participants after that get a queue full answer
+SHORTEST_FIRST = True # Rounds with the shortest predicted training are submitted first, instead of the oldest
+DISPATCH = "slurm" # "slurm" submits every round with sbatch, "daemon" hands it to running worker daemons
+QUEUE_DIR = "job_queue" # Shared with the worker daemons, started with worker2.py --serve job_queue
+DAEMON_TIMEOUT = 600 # Seconds a worker daemon may be silent while running a job
+DAEMON_CLAIM_TIMEOUT = 120 # Seconds a job may wait in QUEUE_DIR for a daemon to take it before it is withdrawn
+DAEMON_FALLBACK = "slurm" # Where a withdrawn job goes: "slurm" submits it with sbatch, None fails the round
+SLURM_SCRIPT = "worker_job.slurm"
+ARRAY_JOBS = True # One SLURM array task per maze, so the mazes of a round can run on separate nodes
+ARRAY_TASK_CPUS = 1
+JOB_WORKERS = 4 # Training processes of a job without ARRAY_JOBS, the cpus-per-task of worker_job.slurm
+# Scheduler commands, point these at local_sbatch.py to run everything on this machine
+SBATCH = shlex.split(os.environ.get("SBATCH", "sbatch"))
+SACCT = shlex.split(os.environ.get("SACCT", "sacct"))
+SQUEUE = shlex.split(os.environ.get("SQUEUE", "squeue"))
+SCANCEL = shlex.split(os.environ.get("SCANCEL", "scancel"))
+NOTIFY_BIND = '0.0.0.0' # Workers report progress and completion here, must be reachable from the compute nodes
+NOTIFY_PORT = 10023
+NOTIFY_HOST = socket.gethostname() # Address the workers connect to
+SCHEDULER_POLL = 30 # Seconds without notification before asking SLURM about the job
+METRICS_PORT = 10024 # Stage timings in the Prometheus text format on http://HOST:METRICS_PORT/metrics, None to turn off
+
+FAILED_STATES = {"FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL", "OUT_OF_MEMORY", "PREEMPTED", "BOOT_FAIL", "DEADLINE"}
+
+# Predicts training times from the trainings the workers recorded in the shared training log
+cost_model = CostModel()
+# Folders of the trainings. The workers leave their changes in files, only this process writes the index.
+store = ResultsStore()
+
+# Messages of running jobs by job token, filled by the notification listener
+jobs = {}
+jobs_lock = threading.Lock()
+
+def submit_job(args, options=()):
+    # Returns the SLURM job id
+    slurm_command = [*SBATCH, "--parsable", *options, SLURM_SCRIPT, *args]
+    result = subprocess.run(slurm_command, capture_output=True, text=True, check=True)
+    return result.stdout.strip().split(";")[0]
+
+def job_states(job_id):
+    # Asks the scheduler for the state of a job, one per task for job arrays.
+    # Used when the worker has not been heard from in a while.
+    for command in ([*SACCT, "-j", job_id, "-n", "-X", "-o", "State"], [*SQUEUE, "-h", "-j", job_id, "-o", "%T"]):
+        try:
+            output = subprocess.run(command, capture_output=True, text=True, timeout=30).stdout
+        except (OSError, subprocess.SubprocessError):
+            continue
+        # sacct shows "CANCELLED by <uid>", only the first word is the state
+        states = [line.split()[0].rstrip("+") for line in output.splitlines() if line.strip()]
+        if states:
+            return states
+    return []
 
-def handle_client_connection(client_socket):
+class JobNotClaimed(Exception):
+    pass
+
+def withdraw_job(job_file):
+    # Takes a job back out of the queue, False if a daemon claimed it first. Renaming is atomic, as in claim_job.
+    withdrawn = job_file.with_suffix(".withdrawn")
     try:
-        data = client_socket.recv(BUFFER_SIZE).decode()
-        received_data = json.loads(data)
+        os.rename(job_file, withdrawn)
+    except FileNotFoundError:
+        return False
+    withdrawn.unlink(missing_ok=True)
+    return True
 
-        participant_id = received_data.get("participant_id")
-        maze_strings = received_data.get("maze_data")
-        print("Received participant ID:", participant_id)
-        print("Received maze strings:", maze_strings)
+def wait_for_job(job_ids, messages, output_file, progress, job_file=None):
+    # Returns when the worker reported the round is done, raises when it failed or SLURM ended a job.
+    # The last job is the one that writes the output file. job_file is set for jobs of the worker daemons,
+    # JobNotClaimed is raised when no daemon took it within DAEMON_CLAIM_TIMEOUT.
+    silent = 0
+    unclaimed = 0
+    while True:
+        try:
+            message = messages.get(timeout=SCHEDULER_POLL)
+        except queue.Empty:
+            if job_file is not None and job_file.exists(): # No daemon running, or all of them busy
+                unclaimed += SCHEDULER_POLL
+                if unclaimed >= DAEMON_CLAIM_TIMEOUT and withdraw_job(job_file):
+                    raise JobNotClaimed(f"No worker daemon took {job_file.name} within {DAEMON_CLAIM_TIMEOUT}s")
+            elif job_file is not None: # Taken by a daemon, which reports regularly
+                silent += SCHEDULER_POLL
+                if silent >= DAEMON_TIMEOUT:
+                    raise RuntimeError(f"Worker daemon stopped responding to {job_file.name}")
+            for job_id in job_ids:
+                states = job_states(job_id)
+                failed = [state for state in states if state in FAILED_STATES]
+                if failed:
+                    raise RuntimeError(f"SLURM job {job_id} ended with state {failed[0]}")
+            if os.path.exists(output_file): # The notification got lost
+                return
+            continue
+        silent = 0
+        if message["event"] == "done":
+            return
+        if message["event"] == "failed":
+            raise RuntimeError(f"SLURM job failed: {message.get('message')}")
+        progress(message)
+
+def queue_job(args, token):
+    # Hands the job to the worker daemons (worker2.py --serve QUEUE_DIR), returns the job file
+    queue_dir = pathlib.Path(QUEUE_DIR)
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    job_file = queue_dir / f"{time.time_ns()}-{token}.json"
+    tmp_file = job_file.with_suffix(".tmp") # Daemons only take .json files, so they never see half a job
+    with open(tmp_file, "w") as f:
+        json.dump({"args": args}, f)
+    os.replace(tmp_file, job_file)
+    return job_file
+
+def submit_round(args, count):
+    # Submits a round with sbatch, returns the job ids. The last job is the one that writes the output file.
+    if not ARRAY_JOBS:
+        return [submit_job(args)]
+    # One array task per maze, the gather job builds the round once all of them succeeded
+    array_id = submit_job(args + ["--array-task"], [f"--array=0-{count - 1}", f"--cpus-per-task={ARRAY_TASK_CPUS}"])
+    gather_id = submit_job(args + ["--gather"], [f"--dependency=afterok:{array_id}", "--kill-on-invalid-dep=yes",
+                                                 "--cpus-per-task=1"])
+    return [array_id, gather_id]
+
+def cancel_jobs(job_ids):
+    try:
+        subprocess.run([*SCANCEL, *job_ids], capture_output=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Could not cancel jobs {job_ids}: {e}")
 
-        data_file = f"data_{participant_id}.json"
-        with open(data_file, "w") as f:
-            json.dump(received_data, f)
+def round_cost(received_data, progress):
+    # Predicted seconds of a round, the client gets it as ETA. Array tasks train all mazes at once.
+    workers = len(received_data.get("maze_data")) if ARRAY_JOBS else JOB_WORKERS
+    return cost_model.round_seconds(received_data.get("maze_data"), received_data.get("selected") is not None, workers)
 
+def process_round(received_data, progress):
+    # Runs in a slot of the round queue
+    participant_id = received_data.get("participant_id")
+    tags = {"participant": participant_id, "round": received_data.get("round")}
+    start = time.perf_counter()
+    data_file = f"data_{participant_id}.json"
+    output_file = f"image_paths_{participant_id}.json"
+    with open(data_file, "w") as f:
+        json.dump(received_data, f)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    token = f"{participant_id}-{uuid.uuid4().hex}"
+    messages = queue.Queue()
+    with jobs_lock:
+        jobs[token] = messages
+    job_ids = []
+    job_file = None
+    try:
         # SLURM
-        slurm_command = ["sbatch", "worker.slurm", data_file]
-        subprocess.run(slurm_command)
+        args = ["--data-file", data_file, "--output-file", output_file,
+                "--notify", f"{NOTIFY_HOST}:{NOTIFY_PORT}", "--job-token", token]
+        count = len(received_data.get("maze_data"))
+        with metrics.timer("submit", **tags):
+            if DISPATCH == "daemon":
+                job_file = queue_job(args, token)
+            else:
+                job_ids = submit_round(args, count)
+        print(f"Submitted jobs {job_ids or job_file} for participant {participant_id}")
+        with metrics.timer("job_wait", **tags):
+            try:
+                wait_for_job(job_ids, messages, output_file, progress, job_file)
+            except JobNotClaimed as e:
+                job_file = None # Withdrawn from the queue
+                if DAEMON_FALLBACK != "slurm":
+                    raise RuntimeError(f"{e}, the server is busy, please try again later") from e
+                print(f"{e}, submitting it with sbatch instead")
+                progress({"event": "notice", "message": "All workers are busy, the round was moved to the cluster queue"})
+                with metrics.timer("submit", **tags):
+                    job_ids = submit_round(args, count)
+                wait_for_job(job_ids, messages, output_file, progress)
+    except Exception:
+        if job_ids:
+            cancel_jobs(job_ids)
+        if job_file is not None:
+            job_file.unlink(missing_ok=True) # Not taken by a daemon yet
+        raise
+    finally:
+        with jobs_lock:
+            jobs.pop(token, None)
 
-        # Wait for SLURM job to complete (Is a simple way to wait, make into more robust solution if needed)
-        output_file = f"image_paths_{participant_id}.json"
-        while not os.path.exists(output_file):
-            time.sleep(5)
+    if not os.path.exists(output_file):
+        raise RuntimeError(f"SLURM jobs {job_ids} finished without results")
+    with metrics.timer("decode", **tags):
         with open(output_file, 'r') as f:
             image_paths = json.load(f)
+        images = [base64.b64decode(image) for image in image_paths]
+    store.ingest() # The runs of the round and which of them the participant picked
+    metrics.record("round", time.perf_counter() - start, **tags)
+    return images
+
+async def handle_notification(reader, writer):
+    # Workers keep this connection open for the whole job and send one JSON line per message
+    try:
+        async for line in reader:
+            message = json.loads(line)
+            with jobs_lock:
+                messages = jobs.get(message.pop("job", None))
+            if messages is not None:
+                messages.put(message)
+    except (ConnectionError, ValueError) as e:
+        print("Notification error:", e)
+    finally:
+        writer.close()
+
+async def handle_client_connection(reader, writer, round_queue):
+    try:
+        start = time.perf_counter()
+        received_data, framed = await read_request(reader)
+        metrics.record("receive", time.perf_counter() - start, participant=received_data.get("participant_id"),
+                       round=received_data.get("round"))
+        if "image_id" in received_data: # The client zooms into a result of an earlier round
+            await send_full_image(writer, received_data["image_id"], framed)
+            return
+
+        participant_id = received_data.get("participant_id")
+        maze_strings = received_data.get("maze_data")
+        print("Received participant ID:", participant_id)
+        print("Received maze strings:", maze_strings)
 
-        # Send images back to client
-        response_data = json.dumps(image_paths)
-        client_socket.sendall(response_data.encode())
+        await run_round(writer, round_queue, received_data, framed, reader)
 
     except Exception as e:
         print("Error:", e)
 
     finally:
-        client_socket.close()
+        writer.close()
 
-def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_address = (HOST, PORT)
-    server_socket.bind(server_address)
-    server_socket.listen(5)
-    print(f"Server listening on {HOST}:{PORT}")
+async def serve():
+    round_queue = RoundQueue(process_round, TRAINING_SLOTS, QUEUE_SIZE, cost=round_cost, shortest_first=SHORTEST_FIRST)
+    round_queue.start()
+    if METRICS_PORT is not None:
+        metrics.serve_metrics(METRICS_PORT)
+    store.start_collector()
+    await asyncio.start_server(handle_notification, NOTIFY_BIND, NOTIFY_PORT)
+    print(f"Listening for job notifications on {NOTIFY_BIND}:{NOTIFY_PORT}")
+    await server_core.serve(functools.partial(handle_client_connection, round_queue=round_queue), HOST, PORT)
 
+def main():
     try:
-        while True:
-            client_socket, client_address = server_socket.accept()
-            print("Accepted connection from", client_address)
-            # Make a new thread
-            client_thread = threading.Thread(target=handle_client_connection, args=(client_socket,))
-            client_thread.start()
-
+        asyncio.run(serve())
     except KeyboardInterrupt:
         print("Server stopped.")
 
-    finally:
-        server_socket.close()
-
 if __name__ == "__main__":
     main()
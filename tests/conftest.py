@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The modules are scripts in the root of the repository, not a package
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
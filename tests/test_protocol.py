@@ -0,0 +1,42 @@
+import asyncio
+import json
+
+import pytest
+
+from protocol import JSON_FRAME, pack_json, read_frame, recv_frame
+
+class ShortReads:
+    # Socket that returns at most chunk bytes per recv_into, like a slow connection
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def recv_into(self, view, size):
+        n = min(size, self.chunk, len(self.data))
+        view[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
+def test_recv_frame_short_reads():
+    request = {"participant_id": "p1", "maze_data": ["M5_S0"] * 100}
+    frame_type, payload = recv_frame(ShortReads(pack_json(request), chunk=3))
+    assert frame_type == JSON_FRAME
+    assert json.loads(payload) == request
+
+def test_recv_frame_closed_mid_frame():
+    with pytest.raises(ConnectionError):
+        recv_frame(ShortReads(pack_json({"participant_id": "p1"})[:-2], chunk=5))
+
+def test_read_frame_in_pieces():
+    frame = pack_json({"participant_id": "p1"})
+
+    async def read():
+        reader = asyncio.StreamReader()
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(frame), 4): # Fed after read_frame started waiting
+            loop.call_soon(reader.feed_data, frame[start:start + 4])
+        return await read_frame(reader)
+
+    frame_type, payload = asyncio.run(read())
+    assert frame_type == JSON_FRAME
+    assert payload == b'{"participant_id": "p1"}'
@@ -0,0 +1,21 @@
+import os
+
+from result_cache import ResultCache
+
+def make_training(folder, size):
+    (folder / "trajectories").mkdir(parents=True)
+    (folder / "trajectories" / "eval_final.png").write_bytes(b"x" * size)
+    return folder
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(tmp_path / "cache", max_bytes=250)
+    cache.put("a", make_training(tmp_path / "a", 100))
+    cache.put("b", make_training(tmp_path / "b", 100))
+    os.utime(cache.root / "a", (1000, 1000)) # a was stored first
+    os.utime(cache.root / "b", (2000, 2000))
+    assert cache.get("a") is not None # and used since
+
+    cache.put("c", make_training(tmp_path / "c", 100))
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
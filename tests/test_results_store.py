@@ -0,0 +1,53 @@
+import pathlib
+import time
+
+import results_store
+from results_store import ResultsStore
+
+def make_run(store, status):
+    folder = store.create("p1", "M5_S0")
+    for name in ("best_model.zip", "trajectories/eval_final.png", "trajectories/eval_1.png", "evaluations.npz"):
+        path = pathlib.Path(folder) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x")
+    folder = store.commit(folder)
+    store.mark([folder], status)
+    return pathlib.Path(folder)
+
+def files(folder):
+    return sorted(path.relative_to(folder).as_posix() for path in folder.rglob("*") if path.is_file())
+
+def test_collect_after_expire_seconds(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "EXPIRE_SECONDS", 3600)
+    store = ResultsStore(tmp_path)
+    selected, final, expired, done = (make_run(store, status) for status in ("selected", "final", "expired", "done"))
+
+    assert store.collect() == (0, 0) # Rounds may still read them
+    assert expired.exists()
+    assert len(files(selected)) == 4
+
+    now = time.time()
+    monkeypatch.setattr(results_store.time, "time", lambda: now + 3601)
+    assert store.collect() == (1, 2)
+    assert not expired.exists()
+    assert files(selected) == ["best_model.zip", "trajectories/eval_final.png"]
+    assert files(final) == ["trajectories/eval_final.png"]
+    assert len(files(done)) == 4 # Not picked yet
+
+def test_changes_of_workers(tmp_path):
+    worker = ResultsStore(tmp_path, index=False)
+    picked = worker.commit(worker.create("p1", "M5_S0"))
+    other = worker.commit(worker.create("p1", "M5_S1"))
+    training = worker.create("p1", "M5_S2")
+    worker.mark([picked, other, training], "done")
+    worker.mark([picked], "selected")
+    worker.mark([other], "expired")
+    assert not (tmp_path / "index.sqlite").exists()
+
+    store = ResultsStore(tmp_path)
+    assert store.ingest() == 8
+    with store._db() as db:
+        status = dict(db.execute("SELECT id, status FROM runs"))
+    assert status == {store._run_id(picked): "selected", store._run_id(other): "expired",
+                      store._run_id(training): "training"}
+    assert store.ingest() == 0
@@ -0,0 +1,103 @@
+import concurrent.futures
+import io
+import json
+import os
+import pathlib
+import sys
+import traceback
+
+import metrics
+
+from PIL import Image
+
+# The timeline of a participant is stored as one tile per round plus a manifest listing them.
+# Every round only writes its own tile, the full timeline.png is composed when it is needed.
+
+def timeline_folder(participant_id):
+    return pathlib.Path(f"results/{participant_id}/timeline")
+
+def read_manifest(participant_id):
+    manifest_path = timeline_folder(participant_id) / "manifest.json"
+    if not manifest_path.exists():
+        return {"rounds": []}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def write_manifest(participant_id, manifest):
+    manifest_path = timeline_folder(participant_id) / "manifest.json"
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def create_round_image(participant_id, round_images):
+    # Stacks the results of a round vertically, the image stays in memory
+    # Since all images are the same size, create a new vertical image for the round
+    image_width, image_height = round_images[0].size
+    round_image = Image.new('RGB', (image_width, image_height * len(round_images)), (255, 255, 255))
+
+    for i, img in enumerate(round_images):
+        y_position = i * image_height
+        round_image.paste(img, (0, y_position))
+
+    return round_image
+
+def append_to_timeline(participant_id, round_image):
+    # Stores the round as the next tile of the timeline
+    folder = timeline_folder(participant_id)
+    folder.mkdir(parents=True, exist_ok=True)
+    manifest = read_manifest(participant_id)
+
+    tile = f"round_{len(manifest['rounds']) + 1:02d}.png"
+    round_image.save(folder / tile)
+    manifest["rounds"].append({"tile": tile, "width": round_image.width, "height": round_image.height})
+    write_manifest(participant_id, manifest)
+    print(f"Saved round {len(manifest['rounds'])} of the timeline to {folder / tile}")
+
+def build_timeline(participant_id):
+    # Composes all rounds horizontally into results/{participant_id}/timeline.png
+    folder = timeline_folder(participant_id)
+    rounds = read_manifest(participant_id)["rounds"]
+    if not rounds:
+        return None
+    width = sum(r["width"] for r in rounds)
+    height = max(r["height"] for r in rounds)
+    big_image = Image.new('RGB', (width, height), (255, 255, 255))
+    x_position = 0
+    for r in rounds:
+        with Image.open(folder / r["tile"]) as tile:
+            big_image.paste(tile, (x_position, 0))
+        x_position += r["width"]
+
+    timeline_image_path = pathlib.Path(f"results/{participant_id}/timeline.png")
+    big_image.save(timeline_image_path)
+    print(f"Saved big image to {timeline_image_path}")
+    return timeline_image_path
+
+_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1) # One thread, so the rounds are stored in order
+
+def persist_round(participant_id, images, final=False):
+    # images are the encoded PNGs of the round, the same buffers that are sent to the client
+    with metrics.timer("composite", participant=participant_id):
+        if images:
+            round_images = [Image.open(io.BytesIO(image)) for image in images]
+            append_to_timeline(participant_id, create_round_image(participant_id, round_images))
+        if final: # Last round of the session, compose the whole timeline
+            build_timeline(participant_id)
+
+def _report_failure(future):
+    if future.exception() is not None:
+        traceback.print_exception(future.exception())
+
+def save_round(participant_id, images, final=False, background=True):
+    # Stores the round in the timeline. In the background the response does not wait for the tile to be written.
+    if not background:
+        persist_round(participant_id, images, final)
+        return None
+    future = _writer.submit(persist_round, participant_id, images, final)
+    future.add_done_callback(_report_failure)
+    return future
+
+if __name__ == "__main__":
+    # python timeline.py <participant_id> builds the timeline of a session by hand
+    build_timeline(sys.argv[1])
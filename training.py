@@ -0,0 +1,481 @@
+import json
+import functools
+import importlib
+import pathlib
+import time
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+from timeline import save_round
+from result_cache import ResultCache, cache_key, file_digest
+from results_store import ResultsStore
+from cost_model import CostModel
+from callbacks import (ReportingEvalCallback, ProgressReporter, MemoryOutputFormat, save_trajectories,
+                       append_learning_log)
+import metrics
+
+from amaze.simu.types import StartLocation
+
+from stable_baselines3.common.callbacks import (CallbackList,
+                                                StopTrainingOnRewardThreshold,
+                                                StopTrainingOnNoModelImprovement)
+from stable_baselines3.common.logger import Logger, make_output_format
+from stable_baselines3.common.monitor import Monitor
+from stable_baselines3.common.vec_env import SubprocVecEnv
+
+from amaze import Maze, Robot
+from amaze.extensions.sb3 import (make_vec_maze_env, env_method,
+                                  load_sb3_controller, PPO,
+                                  TensorboardCallback, sb3_controller)
+from amaze.extensions.sb3.maze_env import MazeEnv
+
+# Training and rounds, shared by serverexample and worker2. The settings are those of serverexample,
+# worker2 sets the ones it trains with differently (BUDGET, DEVICE, TRAJECTORY_EVERY) when it is imported.
+SEED = 0
+BUDGET = 100000
+VERBOSE = False
+ROBOT = "DD"
+HYPERPARAMS = {"policy": "MlpPolicy", "learning_rate": 1e-3} # Passed to PPO, also part of the result cache key
+DEVICE = "cuda" # Torch device of PPO
+TRAJECTORY_EVERY = 10 # Evaluations between trajectory images with TENSORBOARD, the higher, the less images
+
+USE_CACHE = True # Reuse trained models and images of mazes that were trained before with the same settings
+LIBRARY_DIR = "results/library" # Mazes trained ahead of time with pretrain.py, checked before the cache
+PERSIST_ASYNC = True # Write the timeline in a background thread instead of before answering
+STORE_INDEX = True # Write the index of the results store, False leaves the changes to a server (results_store.py)
+WARM_START = True # Continue training from the model the participant selected in the previous round
+WARM_START_BUDGET = 0.5 # Fraction of BUDGET used when training continues from a previous model
+ADAPTIVE_BUDGET = True # Scale BUDGET with the size, traps and intersections of the maze, see maze_budget
+BUDGET_REFERENCE_SIZE = 10 # Mazes of this size get BUDGET, the budget grows with the area of the maze
+BUDGET_TRAP_FACTOR = 2.0 # A maze with trap probability p gets (1 + BUDGET_TRAP_FACTOR * p) times the budget
+BUDGET_UNICURSIVE_FACTOR = 0.5 # Mazes without intersections need less training
+BUDGET_LIMITS = (0.25, 2.0) # Bounds of the scaled budget, as fractions of BUDGET
+PLATEAU_EVALS = 4 # Stop after this many evaluations without a new best reward, None to train until the budget is spent
+PLATEAU_MIN_EVALS = 3 # Evaluations before a plateau can stop the training
+
+SUBPROC_ENVS = False # Step the environments of a training in their own processes, needs 4 * ENV_COPIES spare cores
+ENV_COPIES = 1 # Environments per rotation of the maze, a training steps 4 * ENV_COPIES environments
+LEAN_EVAL = True # Evaluate without logging trajectories, only the final image is rendered, from the best model
+TENSORBOARD = False # Write csv, tensorboard and evaluation files for every training, evaluations are lean without it
+LEARNING_LOG = "learning_log.jsonl" # Values logged during the trainings of a participant, in results/{participant_id}
+
+cost_model = CostModel() # Predicts training times from the trainings done before, for ETAs and the queue order
+
+def make_string(maze_strings):
+    # Construct the received data
+    maze_list = []
+    for maze in maze_strings:
+        seed = maze['Seed']
+        size = maze['Size']
+        traps = maze['Traps']
+        unicursive = maze['Without intersections']
+        start = StartLocation[maze['Start']]
+
+        train_maze_data = Maze.BuildData(
+            width=size, height=size,
+            unicursive=unicursive,
+            start=start,
+            seed=seed,
+            p_lure=0.0, p_trap=traps
+        )
+        #Convert data into string
+        maze_list.append(train_maze_data.to_string())
+
+    return maze_list
+
+def trap_probabilities(maze_strings):
+    # The Traps setting of every maze, a percentage, as a probability. make_string adds no trap signs, so the maze
+    # strings do not carry it and it is passed on next to them.
+    return [maze['Traps'] / 100 for maze in maze_strings]
+
+def training_params(p_trap=0.0):
+    # HYPERPARAMS plus the settings of this module that change the outcome of train(), for the cache keys.
+    # p_trap is the trap probability of the maze, which changes its budget.
+    params = dict(HYPERPARAMS)
+    if ENV_COPIES != 1:
+        params["env_copies"] = ENV_COPIES
+    if ADAPTIVE_BUDGET:
+        params["budget"] = [BUDGET_REFERENCE_SIZE, BUDGET_TRAP_FACTOR, BUDGET_UNICURSIVE_FACTOR, list(BUDGET_LIMITS)]
+        if p_trap:
+            params["p_trap"] = p_trap
+    if PLATEAU_EVALS is not None:
+        params["plateau"] = [PLATEAU_EVALS, PLATEAU_MIN_EVALS]
+    return params
+
+def maze_budget(maze_data, p_trap=0.0):
+    # Timesteps for a maze: BUDGET for a maze of BUDGET_REFERENCE_SIZE, scaled with the area of the maze,
+    # more with traps, less without intersections. p_trap is the requested trap probability, maze_data has none.
+    if not ADAPTIVE_BUDGET:
+        return BUDGET
+    scale = maze_data.width * maze_data.height / BUDGET_REFERENCE_SIZE ** 2
+    scale *= 1 + BUDGET_TRAP_FACTOR * p_trap
+    if maze_data.unicursive:
+        scale *= BUDGET_UNICURSIVE_FACTOR
+    low, high = BUDGET_LIMITS
+    return int(BUDGET * min(max(scale, low), high))
+
+def stop_reason(eval_callback, plateau_callback, optimal_reward):
+    # Which criterion ended a training
+    if eval_callback.best_mean_reward >= optimal_reward:
+        return "threshold"
+    if plateau_callback is not None and plateau_callback.no_improvement_evals > plateau_callback.max_no_improvement_evals:
+        return "plateau"
+    return "budget"
+
+def make_train_env(train_mazes, robot):
+    # One environment per rotation and copy. With SUBPROC_ENVS every environment steps in its own process,
+    # so the rollouts of a single training are collected on several cores.
+    mazes = [maze for maze in train_mazes for _ in range(ENV_COPIES)]
+    if not SUBPROC_ENVS:
+        return make_vec_maze_env(mazes, robot, SEED)
+
+    def make_env(maze):
+        return lambda: Monitor(MazeEnv(maze, robot))
+
+    # Spawn, as for the training processes, forking after torch init is unsafe
+    env = SubprocVecEnv([make_env(maze) for maze in mazes], start_method="spawn")
+    env.seed(SEED)
+    return env
+
+def train(simple_str, FOLDER, init_model=None, progress=None, p_trap=0.0):
+    print(f"training with maze{simple_str}")
+    if progress is not None:
+        progress({"event": "maze_started"})
+    maze_data = Maze.BuildData.from_string(simple_str)
+    train_mazes = maze_data.all_rotations()
+
+    stats = {} # Seconds spent in the stages of the training, recorded by the caller
+    start = time.perf_counter()
+    robot = Robot.BuildData.from_string(ROBOT)
+    # the following environments are equal. Change if needed
+    train_env = make_train_env(train_mazes, robot)
+    # TensorboardCallback writes to the tensorboard files and calls into the training environments directly,
+    # which SUBPROC_ENVS keeps in other processes
+    lean_eval = LEAN_EVAL or SUBPROC_ENVS or not TENSORBOARD
+    eval_env = make_vec_maze_env(train_mazes, robot, SEED, log_trajectory=not lean_eval)
+    stats["env"] = time.perf_counter() - start
+
+    budget = maze_budget(maze_data, p_trap)
+    if init_model is not None:
+        # The previous model already learned most of the maze, so it needs less of the budget
+        budget = int(budget * WARM_START_BUDGET)
+    stats["budget"] = budget
+
+    optimal_reward = (sum(env_method(eval_env, "optimal_reward"))
+                      / len(train_mazes))
+    tb_callback = None if lean_eval else TensorboardCallback(
+        log_trajectory_every=TRAJECTORY_EVERY,
+        max_timestep=budget
+    )
+    # Ends trainings that stopped improving, for mazes that never reach the optimal reward
+    plateau_callback = None if PLATEAU_EVALS is None else StopTrainingOnNoModelImprovement(
+        max_no_improvement_evals=PLATEAU_EVALS, min_evals=PLATEAU_MIN_EVALS, verbose=1)
+    after_eval = [callback for callback in (tb_callback, plateau_callback) if callback is not None]
+    # Both read the results of the evaluation from their parent. EvalCallback is the parent of its
+    # callback_after_eval, but CallbackList only hands its parent on to the callbacks in it from SB3 2.3.
+    after_eval_callback = after_eval[0] if len(after_eval) == 1 else CallbackList(after_eval) if after_eval else None
+    eval_callback = ReportingEvalCallback(
+        eval_env, progress=progress,
+        best_model_save_path=FOLDER, log_path=FOLDER if TENSORBOARD else None,
+        eval_freq=budget//(10*train_env.num_envs), verbose=1,
+        n_eval_episodes=len(train_mazes),
+        callback_after_eval=after_eval_callback,
+        callback_on_new_best=StopTrainingOnRewardThreshold(
+            reward_threshold=optimal_reward, verbose=1)
+    )
+    for callback in after_eval:
+        callback.parent = eval_callback
+
+    if init_model is not None:
+        print(f"Warm start from {init_model}")
+        model = load_sb3_controller(init_model)
+        model.set_env(train_env)
+        model.set_random_seed(SEED)
+    else:
+        model = sb3_controller(
+            PPO, env=train_env, seed=SEED, device=DEVICE, **HYPERPARAMS)
+
+    print("== Starting", "="*68)
+    # The logged values are kept in memory and written to the learning log of the participant once, after training
+    learning_log = MemoryOutputFormat()
+    file_formats = ["csv", "tensorboard"] if TENSORBOARD else []
+    model.set_logger(Logger(FOLDER, [learning_log] + [make_output_format(name, FOLDER) for name in file_formats]))
+    start = time.perf_counter()
+    image = None
+    try:
+        model.learn(budget, callback=eval_callback, progress_bar=False)
+        # Evaluations happen inside learn, they are counted separately
+        stats["evals"] = eval_callback.eval_seconds
+        stats["learn"] = time.perf_counter() - start - sum(stats["evals"])
+        stats["timesteps"] = int(model.num_timesteps)
+        stats["solved"] = bool(eval_callback.best_mean_reward >= optimal_reward) # Stopped at the reward threshold
+        stats["stop"] = stop_reason(eval_callback, plateau_callback, optimal_reward)
+        print(f"Training stopped by {stats['stop']} after {stats['timesteps']} of {budget} timesteps")
+        stats["log"] = learning_log.table()
+
+        if tb_callback is not None:
+            tb_callback.log_step(True)
+        else:
+            # The periodic evaluations only computed rewards, the trajectories are rendered once here
+            start = time.perf_counter()
+            final_env = make_vec_maze_env(train_mazes, robot, SEED, log_trajectory=True)
+            image = save_trajectories(best_model(FOLDER, model), final_env, FOLDER)
+            stats["render"] = time.perf_counter() - start
+    finally:
+        model.logger.close() # Closes the csv and tensorboard files, also when the training failed
+        train_env.close() # Ends the environment processes with SUBPROC_ENVS
+    print("="*80)
+    if image is None:
+        # TensorboardCallback saved the final trajectory image, it is read once here and handed on in memory
+        time.sleep(2)
+        start = time.perf_counter()
+        image = read_image(FOLDER)
+        stats["image"] = time.perf_counter() - start
+    return image, stats
+
+def _init_worker(torch_threads, server=None):
+    # Runs once in every training process, so the workers do not all claim every core.
+    # server is the module whose settings the trainings use, spawned processes do not import it otherwise
+    # unless it is the main script.
+    import torch
+    torch.set_num_threads(torch_threads)
+    if server is not None:
+        importlib.import_module(server)
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_manager():
+    # Its queues carry the progress events out of the training processes
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = multiprocessing.get_context("spawn").Manager()
+        return _manager
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    if not USE_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
+
+_store = None
+
+def get_store():
+    # Folders of the trainings, see results_store.py
+    global _store
+    with _cache_lock:
+        if _store is None:
+            _store = ResultsStore(index=STORE_INDEX)
+        return _store
+
+_library = None
+
+def get_library():
+    # The library is filled by pretrain.py and never evicted, None if there is none
+    global _library
+    if _library is None and os.path.isdir(LIBRARY_DIR):
+        _library = ResultCache(LIBRARY_DIR, max_bytes=None)
+    return _library
+
+def record_round(participant_id, sources, selected=None, final=False):
+    # Remember where the models of this round are stored, the participant picks one of them for the next round.
+    # The runs of the previous round the participant did not pick are left to the collector of the store.
+    results_folder = pathlib.Path(f"results/{participant_id}")
+    results_folder.mkdir(parents=True, exist_ok=True)
+    last_round_path = results_folder / "last_round.json"
+    store = get_store()
+    if last_round_path.exists():
+        with open(last_round_path, "r") as f:
+            previous = json.load(f)
+        picked = previous[selected] if selected is not None and 0 <= selected < len(previous) else None
+        store.mark([source for source in previous if source != picked], "expired")
+        store.mark([picked] if picked is not None else [], "selected")
+    store.mark(sources, "final" if final else "done")
+    tmp_path = last_round_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump([str(source) for source in sources], f)
+    os.replace(tmp_path, last_round_path)
+
+def best_model(folder, model):
+    # The model EvalCallback saved as best, or model if no evaluation took place
+    model_path = pathlib.Path(folder) / "best_model.zip"
+    return load_sb3_controller(str(model_path)) if model_path.exists() else model
+
+def last_selected_model(participant_id, selected):
+    last_round_path = pathlib.Path(f"results/{participant_id}/last_round.json")
+    if selected is None or not last_round_path.exists():
+        return None
+    with open(last_round_path, "r") as f:
+        sources = json.load(f)
+    if not 0 <= selected < len(sources):
+        return None
+    model_path = pathlib.Path(sources[selected]) / "best_model.zip"
+    # The model may be gone if the cache evicted it, training then starts from scratch
+    return str(model_path) if model_path.exists() else None
+
+def lookup(cache, simple_str, init_model=None, p_trap=0.0):
+    # Returns the cache key of a maze and its cache entry, or None as entry on a miss.
+    # A cached result of a full training is preferred over a warm start, the library over the cache.
+    key = cache_key(simple_str, ROBOT, SEED, BUDGET, training_params(p_trap))
+    library = get_library()
+    entry = library.get(key) if library is not None else None
+    if entry is None and cache is not None:
+        entry = cache.get(key)
+    if entry is None and init_model is not None:
+        key = cache_key(simple_str, ROBOT, SEED, BUDGET, dict(training_params(p_trap), warm_start=file_digest(init_model)))
+        entry = cache.get(key) if cache is not None else None
+    return key, entry
+
+def keep_training(cache, key, simple_str, FOLDER, warm_start, stats, participant_id, p_trap=0.0, **tags):
+    # Moves a finished training into place and records it, returns where its results are kept from now on
+    FOLDER = get_store().commit(FOLDER)
+    metrics.record_training(stats, maze=simple_str, **tags)
+    append_learning_log(f"results/{participant_id}/{LEARNING_LOG}", stats, maze=simple_str, **tags)
+    cost_model.record_training(Maze.BuildData.from_string(simple_str), warm_start, stats, p_trap, **tags)
+    entry = cache.put(key, FOLDER) if cache is not None else None
+    if entry is not None: # The cache holds what is kept of the training
+        get_store().mark([FOLDER], "expired")
+    return entry or FOLDER
+
+def read_image(source):
+    eval_image_path = pathlib.Path(source) / f"trajectories/eval_final.png"
+    if not os.path.exists(eval_image_path):
+        return None
+    with open(eval_image_path, "rb") as image_file:
+        return image_file.read()
+
+def _forward_events(events, forward):
+    # Hands the events of the training processes on in the order they arrive, until None is received
+    while True:
+        item = events.get()
+        if item is None:
+            return
+        forward(*item)
+
+def main_learning(simple_strs, participant_id, is_test=False, selected=None, progress=None, final=False, tags=None,
+                  pool_for=None, in_flight=None, traps=None, drop_pool=None):
+    # progress(event, image=None) is called with the events of every maze while the round is running.
+    # tags are added to the timings of the trainings in the metrics. traps are the trap probabilities of the mazes,
+    # see trap_probabilities.
+    # pool_for(trainings) returns the process pool the trainings of the round run in, or None to run them one after
+    # another in this process. drop_pool(pool) is called when a process of the pool died (OOM kill, crash in torch),
+    # which breaks the pool for good, so the next round gets a new one.
+    # in_flight, an InFlight shared by the rounds running at the same time, lets a round wait for a training another
+    # round is running instead of training the same maze again.
+    cache = get_cache()
+    init_model = last_selected_model(participant_id, selected) if WARM_START else None
+    traps = traps or [0.0] * len(simple_strs)
+
+    # Identical mazes of a round are trained once, mazes trained before are taken from the cache
+    keys = []
+    indices = {}
+    sources = {}
+    jobs = {}
+    p_traps = {}
+    owned = {} # Futures of the trainings this round runs, other rounds may wait for them
+    shared = {} # Futures of trainings other rounds run, this round waits for them
+    try:
+        for i, simple_str in enumerate(simple_strs):
+            key, entry = lookup(cache, simple_str, init_model, traps[i])
+            keys.append(key)
+            indices.setdefault(key, []).append(i)
+            p_traps.setdefault(key, traps[i])
+            if key in sources or key in jobs or key in shared:
+                continue
+            if entry is not None:
+                print(f"Cache hit for maze {simple_str}")
+                sources[key] = entry
+                continue
+            if in_flight is None:
+                jobs[key] = (simple_str, get_store().create(participant_id, simple_str), init_model)
+                continue
+            future, owner = in_flight.claim(key)
+            if not owner:
+                print(f"Maze {simple_str} is already being trained for another round, waiting for it")
+                shared[key] = future
+            elif cache is not None and cache.get(key) is not None:
+                # Another round finished it between the lookup and the claim
+                sources[key] = cache.get(key)
+                in_flight.release(key, future, (sources[key], None))
+            else:
+                owned[key] = future
+                jobs[key] = (simple_str, get_store().create(participant_id, simple_str), init_model)
+
+        results = {}
+
+        def report(key, event, image=None):
+            if progress is not None:
+                for index in indices[key]:
+                    progress(dict(event, index=index), image)
+
+        def finish(key, result=None):
+            # result is the image and the timings of a training, or None to read the image from the source
+            image = result[0] if result is not None else None
+            if key in jobs:
+                simple_str, FOLDER, warm_start = jobs[key]
+                sources[key] = keep_training(cache, key, simple_str, FOLDER, warm_start is not None, result[1],
+                                             participant_id, p_traps[key], **(tags or {}))
+            results[key] = image if image is not None else read_image(sources[key])
+            if key in owned:
+                in_flight.release(key, owned[key], (sources[key], results[key]))
+            report(key, {"event": "maze_finished"}, results[key])
+
+        for key in list(sources):
+            finish(key)
+
+        pool = pool_for(len(jobs)) if pool_for is not None else None
+        if pool is not None:
+            events = get_manager().Queue() if progress is not None else None
+            forwarder = threading.Thread(target=_forward_events, args=(events, report))
+            if events is not None:
+                forwarder.start()
+            try:
+                futures = {}
+                for key, job in jobs.items():
+                    reporter = ProgressReporter(events, key) if events is not None else None
+                    futures[pool.submit(train, *job, progress=reporter, p_trap=p_traps[key])] = key
+                # Every maze is reported as soon as it is done, the images below keep the order of the mazes
+                for future in concurrent.futures.as_completed(futures):
+                    finish(futures[future], future.result())
+            except BrokenProcessPool:
+                if drop_pool is not None:
+                    drop_pool(pool)
+                raise
+            finally:
+                if events is not None:
+                    events.put(None)
+                    forwarder.join()
+        else:
+            for key, job in jobs.items():
+                finish(key, train(*job, progress=functools.partial(report, key), p_trap=p_traps[key]))
+
+        # Trainings of other rounds this round waits for
+        waiting = {future: key for key, future in shared.items()}
+        for future in concurrent.futures.as_completed(waiting):
+            sources[waiting[future]], image = future.result()
+            finish(waiting[future], (image, None))
+    finally:
+        # Rounds waiting for a training of this round must not wait forever if it failed
+        for key, future in owned.items():
+            in_flight.release(key, future, error=RuntimeError(f"Training of maze {jobs[key][0]} failed"))
+
+    images = [results[key] for key in keys if results[key] is not None]
+
+    record_round(participant_id, [sources[key] for key in keys], selected, final)
+
+    # The same image buffers go to the client and to the timeline, which is written off the request path
+    save_round(participant_id, images, final, background=PERSIST_ASYNC)
+
+    # Optionally add a delay before the next round
+    #time.sleep(2)
+    return images
@@ -1,167 +1,263 @@
 import json
 import argparse
+import socket
+import traceback
+import functools
 import time
-import shutil
 import pathlib
 import os
 import base64
+import threading
+import multiprocessing
+import concurrent.futures
 
-from amaze.simu.types import InputType, OutputType, StartLocation
-from stable_baselines3.common.callbacks import (EvalCallback, StopTrainingOnRewardThreshold)
-from stable_baselines3.common.logger import configure
-from amaze import Maze, Robot, Simulation, Sign, amaze_main
-from amaze.extensions.sb3 import (make_vec_maze_env, env_method, load_sb3_controller, PPO, TensorboardCallback, sb3_controller, CV2QTGuard)
+import training
+from training import (make_string, trap_probabilities, main_learning, train, get_cache, get_store, last_selected_model, lookup,
+                      keep_training, record_round, read_image, _init_worker, WARM_START, PERSIST_ASYNC)
+import metrics
+from timeline import save_round
 
-SEED = 0
-BUDGET = 5000
-VERBOSE = False
+# The training settings are in training.py, shared with serverexample. A job runs on the CPUs of a compute node
+# with a smaller budget. Set here so the spawned training processes, which import this script, use them too.
+# Jobs run on several nodes at once, the index of the results store is written by socket2 from their changes.
+training.BUDGET = 5000
+training.DEVICE = "cpu"
+training.TRAJECTORY_EVERY = 5
+training.STORE_INDEX = False
 
-def parse_args(): # Accept command-line arguments
+PARALLEL_TRAINING = True # Train the mazes of a round in separate processes instead of one after another
+NUM_WORKERS = int(os.environ.get("SLURM_CPUS_PER_TASK", 4)) # Match --cpus-per-task in worker_job.slurm
+TORCH_THREADS = 1 # Torch threads per training process
+QUEUE_POLL = 0.5 # Seconds between checks of the job queue in --serve mode
+
+def parse_args(argv=None): # Accept command-line arguments
     parser = argparse.ArgumentParser(description="Training script")
-    parser.add_argument('--data-file', type=str, required=True, help='Path to the JSON data file')
-    return parser.parse_args()
+    parser.add_argument('--data-file', type=str, default=None, help='Path to the JSON data file')
+    parser.add_argument('--output-file', type=str, default=None, help='Path of the JSON file the images are written to')
+    parser.add_argument('--notify', type=str, default=None, help='host:port that progress and completion are reported to')
+    parser.add_argument('--job-token', type=str, default=None, help='Identifies this job in the notifications')
+    parser.add_argument('--array-task', action='store_true', help='Train only the maze of this SLURM array task')
+    parser.add_argument('--gather', action='store_true', help='Collect the results of the array tasks into the round')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='Number of parallel training processes')
+    parser.add_argument('--torch-threads', type=int, default=TORCH_THREADS, help='Torch threads per training process')
+    parser.add_argument('--serve', type=str, default=None, metavar='QUEUE_DIR',
+                        help='Keep running and take jobs from QUEUE_DIR, instead of running a single job')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='With --serve, serve the stage timings in the Prometheus text format on this port')
+    args = parser.parse_args(argv)
+    if args.serve is None and args.data_file is None:
+        parser.error("--data-file is required unless --serve is given")
+    return args
 
 def load_data(data_file): # Load the data file
     with open(data_file, 'r') as f:
         data = json.load(f)
     participant_id = data['participant_id']
     maze_strings = data['maze_data']
-    return participant_id, maze_strings
-
-def make_string(maze_strings):
-    maze_list = []
-    for maze in maze_strings:
-        seed = maze['Seed']
-        size = maze['Size']
-        traps = maze['Traps']
-        unicursive = maze['Without intersections']
-        start = StartLocation[maze['Start']]
-
-        train_maze_data = Maze.BuildData(
-            width=size, height=size,
-            unicursive=unicursive,
-            start=start,
-            seed=seed,
-            p_lure=0.0, p_trap=traps
-        )
-        maze_list.append(train_maze_data.to_string())
-    return maze_list
-
-def train(simple_str, FOLDER):
-    print(f"training with maze{simple_str}")
-    train_mazes = Maze.BuildData.from_string(simple_str).all_rotations()
-    robot = Robot.BuildData.from_string("DD")
-
-    train_env = make_vec_maze_env(train_mazes, robot, SEED)
-    eval_env = make_vec_maze_env(train_mazes, robot, SEED, log_trajectory=True)
-
-    optimal_reward = (sum(env_method(eval_env, "optimal_reward")) / len(train_mazes))
-    tb_callback = TensorboardCallback(
-        log_trajectory_every=5,
-        max_timestep=BUDGET
-    )
-    eval_callback = EvalCallback(
-        eval_env,
-        best_model_save_path=FOLDER, log_path=FOLDER,
-        eval_freq=BUDGET // (10 * len(train_mazes)), verbose=1,
-        n_eval_episodes=len(train_mazes),
-        callback_after_eval=tb_callback,
-        callback_on_new_best=StopTrainingOnRewardThreshold(
-            reward_threshold=optimal_reward, verbose=1)
-    )
-
-    model = sb3_controller(
-        PPO, policy="MlpPolicy", env=train_env, seed=SEED, learning_rate=1e-3, device="cpu")
-
-    print("== Starting", "=" * 68)
-    model.set_logger(configure(FOLDER, ["csv", "tensorboard"]))
-    model.learn(BUDGET, callback=eval_callback, progress_bar=False)
-
-    tb_callback.log_step(True)
-    print("=" * 80)
-    time.sleep(2)
-
-def create_round_image(participant_id, round_images):
-    # Image is saved in folder of the participant
-    results_folder = pathlib.Path(f"results/{participant_id}")
-    round_image_path = results_folder / "round_image.png"
-
-    # Since all images are the same size, create a new vertical image for the round
-    image_width, image_height = round_images[0].size
-    
-    round_image = Image.new('RGB', (image_width, image_height * 4), (255, 255, 255))
-
-    for i, img in enumerate(round_images):
-        y_position = i * image_height
-        round_image.paste(img, (0, y_position))
-
-    round_image.save(round_image_path)
-    print(f"Saved round image to {round_image_path}")
-    return round_image_path
-
-def append_to_timeline(participant_id, round_image_path): 
-    results_folder = pathlib.Path(f"results/{participant_id}")
-    timeline_image_path = results_folder / "timeline.png"
-
-    # Load the new round image
-    round_image = Image.open(round_image_path)
-    round_image_width, round_image_height = round_image.size
-
-    # If timeline image doesn't exist, create a new one
-    if not timeline_image_path.exists():
-        big_image = Image.new('RGB', (round_image_width, round_image_height), (255, 255, 255))
-        big_image.paste(round_image, (0, 0))
-        print("Created new big image with the first round.")
+    selected = data.get('selected') # Missing for clients from before warm starting
+    final = data.get('final', False) # Last round of the session
+    round_number = data.get('round') # Only used to tag the timings
+    return participant_id, maze_strings, selected, final, round_number
+
+_pool = None
+_pool_settings = None
+_pool_lock = threading.Lock()
+
+def get_pool(workers, torch_threads):
+    # Kept for the lifetime of the process, so a worker daemon does not start its training processes every round.
+    # Spawn is used since forking after torch init is unsafe.
+    global _pool, _pool_settings
+    with _pool_lock:
+        if _pool is None or _pool_settings != (workers, torch_threads):
+            if _pool is not None:
+                _pool.shutdown()
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(torch_threads,))
+            _pool_settings = (workers, torch_threads)
+        return _pool
+
+def drop_pool(pool):
+    # The pool broke because one of its processes died, the next round of a daemon starts a new one
+    global _pool, _pool_settings
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+            _pool_settings = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def round_pool(trainings, workers, torch_threads):
+    # A single training runs in this process, one-shot jobs then do not start the pool at all
+    if PARALLEL_TRAINING and workers > 1 and trainings > 1:
+        return get_pool(workers, torch_threads)
+    return None
+
+def part_file(output_file, index):
+    return f"{output_file}.part{index}"
+
+def train_task(simple_strs, participant_id, index, output_file, selected=None, progress=None, tags=None, traps=None):
+    # Trains a single maze of the round, as one task of a SLURM job array.
+    # Writes where the result is stored to a part file, which gather_round collects.
+    traps = traps or [0.0] * len(simple_strs)
+    mazes = list(zip(simple_strs, traps))
+    simple_str, p_trap = mazes[index]
+    if mazes[index] in mazes[:index]:
+        # An earlier task of the array trains the same maze
+        part = {"same_as": mazes.index(mazes[index])}
     else:
-        big_image = Image.open(timeline_image_path)
-        big_image = big_image.convert('RGB')  # So it is in the correct mode
-
-        # Create a new big image with space for the new round
-        big_image_width, big_image_height = big_image.size
-        new_big_image = Image.new('RGB', (big_image_width + round_image_width, round_image_height), (255, 255, 255))
-        # Add new image horizontally
-        new_big_image.paste(big_image, (0, 0))
-        new_big_image.paste(round_image, (big_image_width, 0))
-
-        big_image = new_big_image
-        print("Appended new round to the existing big image.")
-
-    big_image.save(timeline_image_path)
-    print(f"Saved big image to {timeline_image_path}")
-
-def main_learning(simple_strs, participant_id, is_test=False):
-    image_paths = []
-    round_images = []
-    for simple_str in simple_strs:
-        t = time.localtime()
-        current_time = time.strftime("%H;%M;%S", t)
-        FOLDER = f"results/{participant_id}/{simple_str}/{current_time}"
-        BEST = f"{FOLDER}/best_model.zip"
-        folder = pathlib.Path(FOLDER)
-        if folder.exists():
-            shutil.rmtree(folder)
-        folder.mkdir(parents=True, exist_ok=False)
-        train(simple_str, FOLDER)
-        eval_image_path = folder / f"trajectories/eval_final.png"
-        if os.path.exists(eval_image_path):
-            with open(eval_image_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                image_paths.append(encoded_string)
-	    # Create timeline directly after maze result has been saved
-            round_images.append(Image.open(eval_image_path))
-
-    round_image_path = create_round_image(participant_id, round_images)
-    append_to_timeline(participant_id, round_image_path)
-
-    return image_paths
+        cache = get_cache()
+        init_model = last_selected_model(participant_id, selected) if WARM_START else None
+        key, source = lookup(cache, simple_str, init_model, p_trap)
+        if source is None:
+            FOLDER = get_store().create(participant_id, simple_str)
+            task_progress = (lambda event: progress(dict(event, index=index))) if progress is not None else None
+            _, stats = train(simple_str, FOLDER, init_model, progress=task_progress, p_trap=p_trap)
+            source = keep_training(cache, key, simple_str, FOLDER, init_model is not None, stats, participant_id,
+                                   p_trap, index=index, **(tags or {}))
+        part = {"source": str(source)}
 
-if __name__ == "__main__":
-    args = parse_args()
-    participant_id, maze_strings = load_data(args.data_file)
-    simple_strs = make_string(maze_strings)
-    image_paths = main_learning(simple_strs, participant_id, is_test=False)
+    tmp_file = f"{part_file(output_file, index)}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(part, f)
+    os.replace(tmp_file, part_file(output_file, index))
+    if progress is not None:
+        progress({"event": "maze_finished", "index": index})
+
+def gather_round(participant_id, output_file, count, selected=None, final=False):
+    # Runs after all tasks of the job array are done: builds the round image, the timeline and the output file
+    sources = []
+    for index in range(count):
+        with open(part_file(output_file, index), "r") as f:
+            part = json.load(f)
+        sources.append(sources[part["same_as"]] if "same_as" in part else part["source"])
+
+    images = [image for image in (read_image(source) for source in sources) if image is not None]
+    record_round(participant_id, sources, selected, final)
+    save_round(participant_id, images, final, background=PERSIST_ASYNC)
+
+    write_output(output_file, images)
+    for index in range(count):
+        os.remove(part_file(output_file, index))
 
-    # Save images to a JSON file (specify as output file in worker_job.slurm)
-    output_file = f"image_paths_{participant_id}.json"
-    with open(output_file, 'w') as f:
+class Notifier:
+    # Sends the progress and the outcome of the job to socket2 over one connection, as JSON lines.
+    # Without a connection the job still runs, socket2 then falls back to asking SLURM.
+    def __init__(self, address, token):
+        self.token = token
+        self.lock = threading.Lock()
+        self.sock = None
+        if address:
+            host, port = address.rsplit(":", 1)
+            try:
+                self.sock = socket.create_connection((host, int(port)), timeout=30)
+            except OSError as e:
+                print(f"Could not connect to {address} for notifications: {e}")
+
+    def __call__(self, event, image=None):
+        self.send(event)
+
+    def send(self, event):
+        with self.lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall((json.dumps(dict(event, job=self.token)) + "\n").encode())
+            except OSError as e:
+                print(f"Lost the notification connection: {e}")
+                self.sock = None
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+def write_output(output_file, images):
+    # Written to a temporary file first, so the output is never seen half written
+    image_paths = [base64.b64encode(image).decode('utf-8') for image in images]
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(image_paths, f)
+    os.replace(tmp_file, output_file)
+
+def run_job(args):
+    participant_id, maze_strings, selected, final, round_number = load_data(args.data_file)
+    output_file = args.output_file or f"image_paths_{participant_id}.json"
+    notifier = Notifier(args.notify, args.job_token)
+    tags = {"participant": participant_id, "round": round_number}
+    try:
+        with metrics.timer("make_string", **tags):
+            simple_strs = make_string(maze_strings)
+        if args.array_task:
+            # One task per maze, SLURM sets the index of the task
+            index = int(os.environ["SLURM_ARRAY_TASK_ID"])
+            train_task(simple_strs, participant_id, index, output_file, selected=selected, progress=notifier,
+                       tags=tags, traps=trap_probabilities(maze_strings))
+            finished = {"event": "task_done", "index": index}
+        elif args.gather:
+            with metrics.timer("gather", **tags):
+                gather_round(participant_id, output_file, len(simple_strs), selected=selected, final=final)
+            finished = {"event": "done"}
+        else:
+            with metrics.timer("round", **tags):
+                pool_for = functools.partial(round_pool, workers=args.workers, torch_threads=args.torch_threads)
+                images = main_learning(simple_strs, participant_id, is_test=False, selected=selected,
+                                       progress=notifier, final=final, tags=tags, pool_for=pool_for,
+                                       drop_pool=drop_pool, traps=trap_probabilities(maze_strings))
+
+            # Save images to a JSON file (specify as output file in worker_job.slurm)
+            with metrics.timer("write_output", **tags):
+                write_output(output_file, images)
+            finished = {"event": "done"}
+    except Exception as e:
+        notifier.send({"event": "failed", "message": str(e)})
+        notifier.close()
+        raise
+    notifier.send(finished)
+    notifier.close()
+
+def claim_job(queue_dir):
+    # Renaming is atomic, so when several daemons share the queue every job is taken by exactly one of them
+    for job_file in sorted(queue_dir.glob("*.json")):
+        claimed = job_file.with_suffix(f".{socket.gethostname()}-{os.getpid()}.claimed")
+        try:
+            os.rename(job_file, claimed)
+        except FileNotFoundError: # Another daemon was first
+            continue
+        return claimed
+    return None
+
+def serve_queue(queue_dir, defaults):
+    # Worker daemon: torch, stable_baselines3, amaze and the training processes stay loaded between rounds.
+    # A job file holds the command line arguments of a single run of this script.
+    queue_dir = pathlib.Path(queue_dir)
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Worker {socket.gethostname()}-{os.getpid()} waiting for jobs in {queue_dir}")
+    get_pool(defaults.workers, defaults.torch_threads) # Start the training processes before the first job arrives
+    if defaults.metrics_port is not None:
+        metrics.serve_metrics(defaults.metrics_port)
+    while True:
+        job_file = claim_job(queue_dir)
+        if job_file is None:
+            time.sleep(QUEUE_POLL)
+            continue
+        try:
+            with open(job_file, "r") as f:
+                job = json.load(f)
+            print(f"Running job {job_file.name}")
+            run_job(parse_args(job["args"] + ["--workers", str(defaults.workers),
+                                              "--torch-threads", str(defaults.torch_threads)]))
+        except Exception:
+            traceback.print_exc() # Already reported to socket2 by run_job, keep serving
+        except SystemExit: # parse_args exits on arguments it does not understand, which must not end the daemon
+            print(f"Skipped job {job_file.name}, its arguments are invalid")
+        finally:
+            job_file.unlink(missing_ok=True)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.serve is not None:
+        serve_queue(args.serve, args)
+    else:
+        run_job(args)